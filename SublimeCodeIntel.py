@@ -33,15 +33,16 @@ VERSION = "3.0.0-rc.1"
 
 import os
 import re
+import time
 import logging
 import textwrap
 import threading
-from collections import deque
+from collections import deque, OrderedDict
 
 import sublime
 import sublime_plugin
 
-from .libs.codeintel import CodeIntel, CodeIntelBuffer, logger as codeintel_logger, logger_level as codeintel_logger_level
+from .libs.codeintel import CodeIntel, CodeIntelBuffer, PRIORITY_OPEN, logger as codeintel_logger, logger_level as codeintel_logger_level
 from .settings import Settings, SettingTogglerCommandMixin
 
 logger_name = 'CodeIntel'
@@ -78,6 +79,166 @@ EXCLUDE_PATHS_MAP = {
 }
 
 
+class LiveTriggerDebouncer(object):
+    """Debounces the live (as you type) triggers of each view.
+
+    A trigger waits a bit longer than the user usually takes between
+    keystrokes, or half the time codeintel is taking to answer if that's
+    longer, so a burst of typing triggers only once, when the user pauses.
+    Trigger characters fire right away. A trigger replaced by a newer one
+    before firing is counted as suppressed.
+    """
+    TRIGGER_CHARS = ('.', '->', '::')
+    MIN_DELAY = 0.02  # seconds
+    TYPING_PAUSE = 1.0  # longer than this between keystrokes isn't typing
+    SMOOTHING = 0.3  # weight of the latest keystroke interval in the average
+
+    def __init__(self):
+        self.typing = {}  # map of view id -> (last keystroke time, average interval)
+        self.pending = {}  # map of view id -> token of the trigger waiting to fire
+        self.fired = 0
+        self.suppressed = 0
+
+    def trigger(self, view, fire, max_delay, latency=0):
+        """Call fire() (in the main thread) once the user pauses typing"""
+        vid = view.id()
+        now = time.time()
+        last, interval = self.typing.get(vid, (None, max_delay))
+        if last is not None and now - last < self.TYPING_PAUSE:
+            interval += self.SMOOTHING * (now - last - interval)
+        self.typing[vid] = (now, interval)
+
+        if vid in self.pending:
+            self.suppressed += 1
+        token = object()
+        self.pending[vid] = token
+
+        def _fire():
+            if self.pending.get(vid) is not token:
+                return  # a newer trigger replaced this one
+            del self.pending[vid]
+            self.fired += 1
+            logger.debug("Live trigger fired (%d fired, %d suppressed)", self.fired, self.suppressed)
+            fire()
+
+        pos = view.sel()[0].end()
+        preceding = view.substr(sublime.Region(max(0, pos - 2), pos))
+        if preceding.endswith(self.TRIGGER_CHARS):
+            _fire()
+            return
+        delay = min(max(interval * 1.5, latency / 2, self.MIN_DELAY), max_delay)
+        sublime.set_timeout(_fire, int(delay * 1000))
+
+    def forget(self, vid):
+        self.typing.pop(vid, None)
+        self.pending.pop(vid, None)
+
+
+class IdleScanScheduler(object):
+    """Scans the open views that changed since they were last scanned, while
+    the user isn't typing.
+
+    Once the editor has been idle for a while, the views are scanned (at
+    PRIORITY_OPEN) one at a time, most recently activated first, skipping
+    the ones whose change count is the one last scanned. A keystroke holds
+    the remaining scans back until the editor is idle again. A scan whose
+    callback doesn't come (the request was dropped) is given up on after
+    SCAN_DEADLINE seconds.
+    """
+
+    SCAN_DEADLINE = 60
+
+    def __init__(self):
+        self.views = OrderedDict()  # map of view id -> view, most recently activated last
+        self.scanned = {}  # map of view id -> change count of the text last scanned
+        self.last_keystroke = 0
+        self.scanning = None  # token of the scan in progress
+        self.timer = None  # token of the tick waiting to run
+        self.scans = 0
+
+    def activated(self, view, scan, idle_delay):
+        """The view got the focus"""
+        vid = view.id()
+        self.views.pop(vid, None)
+        self.views[vid] = view
+        self.schedule(scan, idle_delay)
+
+    def typed(self, view, scan, idle_delay):
+        """The user typed in the view (which pauses the scans)"""
+        self.last_keystroke = time.time()
+        if view.id() not in self.views:
+            self.views[view.id()] = view
+        self.schedule(scan, idle_delay)
+
+    def done(self, vid, change_count):
+        """The text of the view, as of its change count, was scanned"""
+        self.scanned[vid] = change_count
+
+    def forget(self, vid):
+        self.views.pop(vid, None)
+        self.scanned.pop(vid, None)
+
+    def schedule(self, scan, idle_delay, delay=None):
+        """Run the scans once the editor is idle for idle_delay seconds;
+        scan(view, callback) starts scanning the view (calling back when it's
+        done) and returns True, or returns False if the view can't be scanned
+        or None if it can't be scanned yet"""
+        if idle_delay <= 0 or self.timer is not None:
+            return
+        token = object()
+        self.timer = token
+
+        def _tick():
+            if self.timer is not token:
+                return
+            self.timer = None
+            self.tick(scan, idle_delay)
+        sublime.set_timeout(_tick, int((idle_delay if delay is None else delay) * 1000))
+
+    def tick(self, scan, idle_delay):
+        if self.scanning is not None:
+            return  # the next scan is scheduled once this one is done
+        idle = time.time() - self.last_keystroke
+        if idle < idle_delay:
+            self.schedule(scan, idle_delay, idle_delay - idle)
+            return
+        for vid, view in reversed(list(self.views.items())):
+            change_count = view.change_count()
+            if self.scanned.get(vid) == change_count or view.is_loading():
+                continue
+
+            token = object()
+
+            def callback(request, response, vid=vid, change_count=change_count, token=token):
+                sublime.set_timeout(lambda: self._scanned(token, vid, change_count, scan, idle_delay), 0)
+
+            def deadline(vid=vid, token=token):
+                if self.scanning is token:
+                    logger.debug("Idle scan of view %s got no answer, going on", vid)
+                    self.scanning = None
+                    self.schedule(scan, idle_delay, 0)
+
+            started = scan(view, callback)
+            if started:
+                self.scanning = token
+                self.scans += 1
+                logger.debug("Idle scan of view %s (%d scans)", vid, self.scans)
+                sublime.set_timeout(deadline, self.SCAN_DEADLINE * 1000)
+                return
+            if started is None:
+                self.schedule(scan, idle_delay)  # try again later
+                return
+            self.done(vid, change_count)  # nothing to scan until it changes
+
+    def _scanned(self, token, vid, change_count, scan, idle_delay):
+        # (failed scans aren't retried either, until the view changes)
+        if vid in self.views:
+            self.done(vid, change_count)
+        if self.scanning is token:
+            self.scanning = None
+            self.schedule(scan, idle_delay, 0)
+
+
 class CodeintelHandler(object):
     HISTORY_SIZE = 64
     MAX_FILESIZE = 1 * 1024 * 1024   # 1MB
@@ -247,6 +408,7 @@ class CodeintelHandler(object):
         buf.pos = pos
         buf.text_in_current_line = text_in_current_line
         buf.original_pos = original_pos
+        buf.change_count = view.change_count()
 
         prefs = settings.get_prefs(lang)
 
@@ -333,6 +495,78 @@ class CodeintelHandler(object):
         sublime.set_timeout(_set_status_message, 0)
 
     def set_call_tip_info(self, buf, calltip, explicit, trg):
+        # Called from a background thread, prepare everything here and only
+        # show it in the main thread.
+
+        # TODO: This snippets are created and work for Python language def functions.
+        # i.e. in the form: name(arg1, arg2, arg3)
+        # Other languages might need different treatment.
+
+        # Figure out how many arguments are there already:
+        text_in_current_line = buf.text_in_current_line[:-1]  # Remove next char after cursor
+        arguments = text_in_current_line.rpartition('(')[2].replace(' ', '').strip() or 0
+        if arguments:
+            initial_separator = ''
+            if arguments[-1] == ',':
+                arguments = arguments[:-1]
+            else:
+                initial_separator += ','
+            if not text_in_current_line.endswith(' '):
+                initial_separator += ' '
+            arguments = arguments.count(',') + 1 if arguments else 0
+
+        # Insert parameters as snippet:
+        snippet = None
+        tip_info = calltip.split('\n')
+        tip0 = tip_info[0]
+        m = re.search(r'^(.*\()([^\[\(\)]*)(.*)$', tip0)
+        if m:
+            params = [p.strip() for p in m.group(2).split(',')]
+            if params:
+                n = 1
+                tip0 = []
+                snippet = []
+                for i, p in enumerate(params):
+                    if p:
+                        var, sep, default = p.partition('=')
+                        var = var.strip()
+                        tvar = var
+                        if sep:
+                            tvar = "%s<i>=%s</i>" % (tvar, default)
+                        # if i == arguments:
+                        #     tvar = "<b>%s</b>" % tvar
+                        tip0.append(tvar)
+                        if i >= arguments:
+                            if ' ' in var:
+                                var = var.split(' ')[1]
+                            if var[0] == '$':
+                                var = var[1:]
+                            snippet.append('${%s:%s}' % (n, var))
+                            n += 1
+                tip0 = "<h1>%s%s%s</h1>" % (m.group(1), ', '.join(tip0), m.group(3))
+                snippet = ', '.join(snippet)
+                if arguments and snippet:
+                    snippet = initial_separator + snippet
+        css = (
+            "html {background-color: #232628; color: #999999;}" +
+            "body {font-size: 10px; }" +
+            "b {color: #6699cc; }" +
+            "a {color: #99cc99; }" +
+            "h1 {color: #cccccc; font-weight: normal; font-size: 11px; }"
+        )
+
+        # Wrap lines that are too long:
+        wrapper = textwrap.TextWrapper(width=100, break_on_hyphens=False, break_long_words=False)
+        measured_tips = [tip0]
+        for t in tip_info[1:]:
+            measured_tips.extend(wrapper.wrap(t))
+
+        popup = '<style>%s</style>%s<br><br><a href="insert">insert</a>' % (css, "<br>".join(measured_tips))
+
+        # Tooltip snippet (when there are no popups)
+        padding = '   '
+        snippets = [((padding if i > 0 else '') + l + (padding if i > 0 else ''), snippet or '${0}') for i, l in enumerate(measured_tips)]
+
         def _set_call_tip_info():
             view = self.view
             if not view:
@@ -341,81 +575,15 @@ class CodeintelHandler(object):
             if vid != buf.vid:
                 return
 
-            # TODO: This snippets are created and work for Python language def functions.
-            # i.e. in the form: name(arg1, arg2, arg3)
-            # Other languages might need different treatment.
-
-            # Figure out how many arguments are there already:
-            text_in_current_line = buf.text_in_current_line[:-1]  # Remove next char after cursor
-            arguments = text_in_current_line.rpartition('(')[2].replace(' ', '').strip() or 0
-            if arguments:
-                initial_separator = ''
-                if arguments[-1] == ',':
-                    arguments = arguments[:-1]
-                else:
-                    initial_separator += ','
-                if not text_in_current_line.endswith(' '):
-                    initial_separator += ' '
-                arguments = arguments.count(',') + 1 if arguments else 0
-
-            # Insert parameters as snippet:
-            snippet = None
-            tip_info = calltip.split('\n')
-            tip0 = tip_info[0]
-            m = re.search(r'^(.*\()([^\[\(\)]*)(.*)$', tip0)
-            if m:
-                params = [p.strip() for p in m.group(2).split(',')]
-                if params:
-                    n = 1
-                    tip0 = []
-                    snippet = []
-                    for i, p in enumerate(params):
-                        if p:
-                            var, sep, default = p.partition('=')
-                            var = var.strip()
-                            tvar = var
-                            if sep:
-                                tvar = "%s<i>=%s</i>" % (tvar, default)
-                            # if i == arguments:
-                            #     tvar = "<b>%s</b>" % tvar
-                            tip0.append(tvar)
-                            if i >= arguments:
-                                if ' ' in var:
-                                    var = var.split(' ')[1]
-                                if var[0] == '$':
-                                    var = var[1:]
-                                snippet.append('${%s:%s}' % (n, var))
-                                n += 1
-                    tip0 = "<h1>%s%s%s</h1>" % (m.group(1), ', '.join(tip0), m.group(3))
-                    snippet = ', '.join(snippet)
-                    if arguments and snippet:
-                        snippet = initial_separator + snippet
-            css = (
-                "html {background-color: #232628; color: #999999;}" +
-                "body {font-size: 10px; }" +
-                "b {color: #6699cc; }" +
-                "a {color: #99cc99; }" +
-                "h1 {color: #cccccc; font-weight: normal; font-size: 11px; }"
-            )
-
-            # Wrap lines that are too long:
-            wrapper = textwrap.TextWrapper(width=100, break_on_hyphens=False, break_long_words=False)
-            measured_tips = [tip0]
-            for t in tip_info[1:]:
-                measured_tips.extend(wrapper.wrap(t))
-
             if hasattr(view, 'show_popup'):
                 def insert_snippet(href):
                     view.run_command('insert_snippet', {'contents': snippet})
                     view.hide_popup()
 
-                view.show_popup('<style>%s</style>%s<br><br><a href="insert">insert</a>' % (css, "<br>".join(measured_tips)), location=-1, max_width=700, on_navigate=insert_snippet)
+                view.show_popup(popup, location=-1, max_width=700, on_navigate=insert_snippet)
 
             else:
                 # Insert tooltip snippet
-                padding = '   '
-                snippets = [((padding if i > 0 else '') + l + (padding if i > 0 else ''), snippet or '${0}') for i, l in enumerate(measured_tips)]
-
                 buf.cplns = snippets or None
                 if buf.cplns:
                     view.run_command('auto_complete', {
@@ -427,6 +595,10 @@ class CodeintelHandler(object):
         sublime.set_timeout(_set_call_tip_info, 0)
 
     def set_auto_complete_info(self, buf, cplns, trg):
+        # Called from a background thread, format (and sort) the completions
+        # here and only show them in the main thread.
+        _cplns = self.format_completions_by_language(cplns, buf.lang, buf.text_in_current_line, trg.get('type'))
+
         def _set_auto_complete_info():
             view = self.view
             if not view:
@@ -435,8 +607,6 @@ class CodeintelHandler(object):
             if vid != buf.vid:
                 return
 
-            _cplns = self.format_completions_by_language(cplns, buf.lang, buf.text_in_current_line, trg.get('type'))
-
             buf.cplns = _cplns or None
             if buf.cplns:
                 view.run_command('auto_complete', {
@@ -490,6 +660,9 @@ class CodeintelHandler(object):
 
 
 class SublimeCodeIntel(CodeintelHandler, sublime_plugin.EventListener):
+    live_triggers = LiveTriggerDebouncer()
+    idle_scans = IdleScanScheduler()
+
     def observer(self, topic, data):
         def _get_and_log_message(response):
             message = response.get('message')
@@ -550,13 +723,41 @@ class SublimeCodeIntel(CodeintelHandler, sublime_plugin.EventListener):
         if view.is_dirty():
             buf = self.buf_from_view(view)
             if buf:
-                buf.scan_document(self, True)
+                vid, change_count = view.id(), view.change_count()
+
+                def scanned(request, response):
+                    if response.get('success'):
+                        sublime.set_timeout(lambda: self.idle_scans.done(vid, change_count), 0)
+                buf.scan_document(self, True, callback=scanned)
 
     def on_close(self, view):
         vid = view.id()
-        ci.buffers.pop(vid, None)
+        buf = ci.buffers.pop(vid, None)
+        self.live_triggers.forget(vid)
+        self.idle_scans.forget(vid)
+        ci.forget_view(vid)
+        if buf and buf.path and not ci.buf_from_path(buf.path):
+            ci.forget_text(buf.path)
+
+    def scan_when_idle(self, view, callback):
+        """Scan hook of the idle scans"""
+        if not ci.enabled or not ci.languages:
+            return None
+        buf = self.buf_from_view(view)
+        if not buf:
+            return False
+        buf.scan_document(self, False, callback=callback, priority=PRIORITY_OPEN)
+        return True
+
+    def on_activated(self, view):
+        if settings.get('@disable', False):
+            return
+        self.idle_scans.activated(view, self.scan_when_idle, settings.get('idle_scan_delay', 0) / 1000.0)
 
     def on_modified(self, view):
+        if not settings.get('@disable', False):
+            self.idle_scans.typed(view, self.scan_when_idle, settings.get('idle_scan_delay', 0) / 1000.0)
+
         view_sel = view.sel()
         if not view_sel:
             return
@@ -593,10 +794,27 @@ class SublimeCodeIntel(CodeintelHandler, sublime_plugin.EventListener):
                 previous_command[0] == 'insert_best_completion'
             )
         ):
-            buf = self.buf_from_view(view)
-            # print('on_modified.triggering', bool(buf))
-            if buf:
-                buf.trg_from_pos(self, True)
+            def trigger():
+                if not view.sel():
+                    return  # view is gone
+                buf = self.buf_from_view(view)
+                # print('on_modified.triggering', bool(buf))
+                if buf:
+                    buf.complete_at_pos(self, True)
+
+            max_delay = settings.get('live_max_delay', 0) / 1000.0
+            if max_delay > 0:
+                buf = ci.buffers.get(view.id())
+                mgr = ci.mgr_for(buf.lang) if buf else ci.mgr
+                if not mgr:
+                    latency = 0
+                elif mgr.has_capability('complete-at-pos'):
+                    latency = mgr.latency('complete-at-pos')
+                else:
+                    latency = mgr.latency('trg-from-pos') + mgr.latency('eval')
+                self.live_triggers.trigger(view, trigger, max_delay, latency)
+            else:
+                trigger()
 
     def on_selection_modified(self, view):
         pass
@@ -624,7 +842,7 @@ class CodeintelAutoCompleteCommand(CodeintelHandler, sublime_plugin.TextCommand)
         buf = self.buf_from_view(view)
 
         if buf:
-            buf.trg_from_pos(self, True)
+            buf.complete_at_pos(self, True)
 
 
 class CodeintelGoToDefinitionCommand(CodeintelHandler, sublime_plugin.TextCommand):
@@ -698,7 +916,7 @@ class CodeintelSettings(Settings):
         """
         need_deactivate = False
 
-        for setting in ('@disable', 'command', 'oop_mode', 'log_levels'):
+        for setting in ('@disable', 'command', 'oop_mode', 'log_levels', 'capabilities', 'compression_threshold', 'batch_max_bytes', 'batch_max_latency', 'engine', 'in_flight_window', 'hot_standby', 'shards', 'max_processes', 'scan_worker'):
             if (
                 setting in self.changeset or
                 self.previous_settings and self.previous_settings.get(setting) != self.settings.get(setting)
@@ -728,8 +946,13 @@ class CodeintelSettings(Settings):
 
             prefs = self.get_prefs()
 
+            ci.completion_cache.configure(
+                size=self.settings.get('completion_cache_size'),
+                ttl=self.settings.get('completion_cache_ttl'),
+            )
+
             if ci.enabled:
-                ci.mgr.set_global_environment(
+                ci.set_global_environment(
                     env=env,
                     prefs=prefs,
                 )
@@ -737,6 +960,16 @@ class CodeintelSettings(Settings):
                 command = self.settings.get('command')
                 oop_mode = self.settings.get('oop_mode')
                 log_levels = self.settings.get('log_levels')
+                capabilities = self.settings.get('capabilities')
+                compression_threshold = self.settings.get('compression_threshold')
+                batch_max_bytes = self.settings.get('batch_max_bytes')
+                batch_max_latency = self.settings.get('batch_max_latency')
+                engine = self.settings.get('engine')
+                in_flight_window = self.settings.get('in_flight_window')
+                hot_standby = self.settings.get('hot_standby')
+                shards = self.settings.get('shards')
+                max_processes = self.settings.get('max_processes')
+                scan_worker = self.settings.get('scan_worker')
                 ci.activate(
                     reset_db_as_necessary=False,
                     codeintel_command=command,
@@ -744,6 +977,16 @@ class CodeintelSettings(Settings):
                     log_levels=log_levels,
                     env=env,
                     prefs=prefs,
+                    capabilities=capabilities,
+                    compression_threshold=compression_threshold,
+                    batch_max_bytes=batch_max_bytes,
+                    batch_max_latency=batch_max_latency,
+                    engine=engine,
+                    in_flight_window=in_flight_window,
+                    hot_standby=hot_standby,
+                    shards=shards,
+                    max_processes=max_processes,
+                    scan_worker=scan_worker,
                 )
 
     def get_prefs(self, lang=None):
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Compare keystroke-to-popup latency of the two-step autocomplete flow
+(trg-from-pos, then eval of the returned trigger) against the single
+complete-at-pos request (complete-at-pos capability).
+
+A forked peer plays the codeintel child: it takes the given time (in
+milliseconds) to find the trigger and to evaluate it, and answers with a
+trigger and a completion list of the given size. Requests go through the
+CodeIntelManager (request queue, sending thread and response workers) as
+they do in the editor; timings go from the keystroke (the request being
+sent) until the popup is shown. Every hop to the editor's main thread
+(sublime.set_timeout) is modeled by the given delay: the two-step flow
+takes one between the trigger and its eval, and both take one to show the
+completions.
+
+Usage: python benchmarks/complete_latency.py [trg ms] [eval ms] [completions] [main thread hop ms]
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import sys
+import time
+import threading
+import multiprocessing
+
+import frames  # noqa (sets up the import path)
+
+from libs.codeintel import CodeIntelManager, _FrameReader, _decode_frame, _PipeConnection, _TCPConnection, _UnixConnection
+from transport_latency import _PeerPipe, _PeerSocket, encode
+
+ROUNDS = 200
+
+TRG = {'form': 0, 'type': 'object-members', 'lang': 'Python', 'pos': 1000, 'implicit': True, 'length': 1}
+
+
+def peer(args, trg_time, eval_time, cplns):
+    option, address = args
+    if option == '--pipe':
+        stream = _PeerPipe(address)
+    else:
+        import socket
+        if option == '--tcp':
+            host, port = address.rsplit(':', 1)
+            sock = socket.create_connection((host, int(port)))
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(address)
+        stream = _PeerSocket(sock)
+    trg_response = {'success': True, 'trg': TRG}
+    eval_response = {'success': True, 'retrigger': False, 'cplns': [['function', 'name%d' % i] for i in range(cplns)]}
+    reader = _FrameReader(stream)
+    try:
+        while True:
+            request = _decode_frame(reader.read_frame())
+            command = request['command']
+            if command == 'trg-from-pos':
+                time.sleep(trg_time)
+                response = trg_response
+            elif command == 'eval':
+                time.sleep(eval_time)
+                response = eval_response
+            else:
+                time.sleep(trg_time + eval_time)
+                response = dict(eval_response, trg=TRG)
+            stream.write(encode(dict(response, req_id=request['req_id'])))
+    except IOError:
+        pass
+
+
+class _Service(object):
+    languages = {}
+
+    def __init__(self):
+        self._mgr_lock = threading.Lock()
+
+
+def reader(mgr):
+    frames = _FrameReader(mgr.pipe)
+    try:
+        while True:
+            mgr._receive(frames.read_frame())
+    except Exception:
+        pass  # connection closed
+
+
+def main_thread(hop, fn):
+    """Run fn after hop seconds, as sublime.set_timeout(fn, 0) would once
+    the main thread gets to it"""
+    timer = threading.Timer(hop, fn)
+    timer.daemon = True
+    timer.start()
+
+
+def two_step(mgr, text, done, hop):
+    def on_trg(request, response):
+        main_thread(hop, lambda: mgr.send(command='eval', vid=1, trg=response['trg'], callback=lambda request, response: main_thread(hop, done.set)))
+    mgr.send(command='trg-from-pos', vid=1, path='/bench.py', pos=1000, implicit=True, text=text, callback=on_trg)
+
+
+def compound(mgr, text, done, hop):
+    mgr.send(command='complete-at-pos', vid=1, path='/bench.py', pos=1000, implicit=True, text=text, callback=lambda request, response: main_thread(hop, done.set))
+
+
+def measure(mgr, flow, text, hop):
+    timings = []
+    done = threading.Event()
+    for i in range(ROUNDS):
+        done.clear()
+        start = time.time()
+        flow(mgr, text, done, hop)
+        done.wait()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.95)] * 1000
+
+
+def main(args):
+    trg_time = float(args[0]) / 1000 if len(args) > 0 else 0.001
+    eval_time = float(args[1]) / 1000 if len(args) > 1 else 0.005
+    cplns = int(args[2]) if len(args) > 2 else 200
+    hop = float(args[3]) / 1000 if len(args) > 3 else 0.005
+    text = "x = 1\n" * 2000
+    transports = [('pipe', _PipeConnection), ('tcp', _TCPConnection)]
+    if _UnixConnection:
+        transports.append(('unix', _UnixConnection))
+    print("trigger %.1f ms, eval %.1f ms, %d completions, main thread hop %.1f ms" % (trg_time * 1000, eval_time * 1000, cplns, hop * 1000))
+    print("%-6s %12s %12s %12s %12s" % ("mode", "2-step p50", "2-step p95", "single p50", "single p95"))
+    for name, cls in transports:
+        conn = cls()
+        process = multiprocessing.Process(target=peer, args=(conn.get_commandline_args(), trg_time, eval_time, cplns))
+        process.start()
+        mgr = CodeIntelManager(_Service())
+        mgr.pipe = conn.get_stream()
+        conn.cleanup()
+        mgr.state = CodeIntelManager.STATE_READY
+        mgr._response_workers.start()
+        mgr._start_sending()
+        thread = threading.Thread(target=reader, args=(mgr,))
+        thread.daemon = True
+        thread.start()
+        two_p50, two_p95 = measure(mgr, two_step, text, hop)
+        one_p50, one_p95 = measure(mgr, compound, text, hop)
+        print("%-6s %12.3f %12.3f %12.3f %12.3f" % (name, two_p50, two_p95, one_p50, one_p95))
+        mgr.kill()
+        process.terminate()
+        process.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Compare JSON and MessagePack (libs/umsgpack.py) encodings of OOP frames.
+
+Usage: python benchmarks/frame_encoding.py [recorded frames file ...]
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import sys
+import json
+import timeit
+
+from frames import workload
+
+from libs import umsgpack
+from libs.codeintel import _decode_frame
+
+
+def json_dumps(frame):
+    return json.dumps(frame, separators=(',', ':')).encode('utf-8')
+
+
+def main(paths):
+    frames = workload(paths)
+    encodings = (
+        ('json', json_dumps),
+        ('msgpack', umsgpack.dumps),
+    )
+    print("%d frames" % len(frames))
+    print("%-10s %12s %12s %12s" % ("encoding", "bytes", "encode ms", "decode ms"))
+    for name, dumps in encodings:
+        encoded = [memoryview(dumps(frame)) for frame in frames]
+        for frame, data in zip(frames, encoded):
+            assert _decode_frame(data) == frame
+        size = sum(len(data) for data in encoded)
+        number = 5
+        encode = min(timeit.repeat(lambda: [dumps(frame) for frame in frames], number=number, repeat=3)) / number
+        decode = min(timeit.repeat(lambda: [_decode_frame(data) for data in encoded], number=number, repeat=3)) / number
+        print("%-10s %12d %12.2f %12.2f" % (name, size, encode * 1000, decode * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
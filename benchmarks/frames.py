@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Frames workload shared by the OOP protocol benchmarks.
+
+Recorded frames can be given either as raw OOP streams (as written to or
+read from the codeintel pipe) or as JSON lines files (one frame per line);
+without recordings a synthetic workload resembling an editing session is
+used: full-text scans of a large file, trigger requests and big completion
+lists.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import os
+import sys
+import json
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.codeintel import _FrameReader, _decode_frame  # noqa
+
+
+class _FileStream(object):
+    def __init__(self, fp):
+        self.fp = fp
+
+    def readinto(self, b):
+        return self.fp.readinto(b)
+
+
+def load_recorded(path):
+    """Return the list of frames (as dicts) recorded in the file at path"""
+    with open(path, 'rb') as fp:
+        head = fp.read(1)
+        fp.seek(0)
+        if head.isdigit():
+            frames = []
+            reader = _FrameReader(_FileStream(fp))
+            while True:
+                try:
+                    frames.append(_decode_frame(reader.read_frame()))
+                except IOError:
+                    return frames
+        return [json.loads(line.decode('utf-8')) for line in fp if line.strip()]
+
+
+def synthetic(seed=0, text_size=900 * 1024, cplns_count=2000):
+    """Return a list of frames (as dicts) of a synthetic editing session"""
+    rnd = random.Random(seed)
+    words = ['self', 'return', 'def', 'import', 'class', 'value', 'result', 'éxito', 'None', '"""', '\\n']
+    lines = []
+    size = 0
+    while size < text_size:
+        line = ' ' * rnd.choice((0, 4, 8)) + ' '.join(rnd.choice(words) for i in range(rnd.randint(1, 12)))
+        lines.append(line)
+        size += len(line) + 1
+    text = '\n'.join(lines)
+    env = {'env': {'PATH': '/usr/local/bin:/usr/bin:/bin', 'HOME': '/home/user'}, 'prefs': [{'codeintel_scan_files_in_project': True}]}
+    cplns = [[rnd.choice(('function', 'variable', 'class', 'module')), 'name_%d' % i] for i in range(cplns_count)]
+    frames = []
+    for i in range(4):
+        pos = rnd.randint(0, len(text))
+        frames.append({'command': 'scan-document', 'path': '/project/big.py', 'language': 'Python', 'env': env, 'text': text, 'encoding': 'utf-8', 'priority': 1, 'mtime': 1500000000.0, 'req_id': hex(4 * i)})
+        frames.append({'command': 'trg-from-pos', 'path': '/project/big.py', 'language': 'Python', 'pos': pos, 'env': env, 'implicit': True, 'text': text, 'encoding': 'utf-8', 'req_id': hex(4 * i + 1)})
+        frames.append({'req_id': hex(4 * i + 1), 'success': True, 'trg': {'form': 0, 'type': 'object-members', 'lang': 'Python', 'pos': pos, 'implicit': True, 'length': 1, 'extentLength': 0, 'retriggerOnCompletion': False, 'path': '/project/big.py'}})
+        frames.append({'req_id': hex(4 * i + 2), 'success': True, 'cplns': cplns})
+        frames.append({'command': 'report-message', 'type': 'logging', 'message': 'scanning /project/module_%d.py' % i})
+    return frames
+
+
+def workload(paths=None):
+    """Return the frames recorded in paths, or the synthetic ones"""
+    if paths:
+        frames = []
+        for path in paths:
+            frames.extend(load_recorded(path))
+        return frames
+    return synthetic()
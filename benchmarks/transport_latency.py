@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Compare round-trip latency of the OOP transports (pipe, tcp and unix).
+
+A forked peer plays the codeintel child: it reads every frame and answers
+with a small response frame. Both a tiny ping frame and the frames of the
+workload (see frames.py) are timed.
+
+Usage: python benchmarks/transport_latency.py [recorded frames file ...]
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import multiprocessing
+
+from frames import workload
+
+from libs.codeintel import _FrameReader, _PipeConnection, _TCPConnection, _UnixConnection
+
+ROUNDS = 200
+
+
+def encode(obj):
+    data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    return ("%i" % len(data)).encode('utf-8') + data
+
+
+class _PeerPipe(object):
+    def __init__(self, path):
+        # open the ends in the reverse order _PipeConnection.get_stream does
+        self._write = open(os.path.join(path, 'out'), 'wb', 0)
+        self._read = open(os.path.join(path, 'in'), 'rb', 0)
+
+    def readinto(self, b):
+        return self._read.readinto(b)
+
+    def write(self, data):
+        self._write.write(data)
+
+
+class _PeerSocket(object):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def readinto(self, b):
+        return self.sock.recv_into(b)
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+
+def peer(args):
+    option, address = args
+    if option == '--pipe':
+        stream = _PeerPipe(address)
+    elif option == '--tcp':
+        host, port = address.rsplit(':', 1)
+        stream = _PeerSocket(socket.create_connection((host, int(port))))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        stream = _PeerSocket(sock)
+    response = encode({'success': True})
+    reader = _FrameReader(stream)
+    try:
+        while True:
+            reader.read_frame()
+            stream.write(response)
+    except IOError:
+        pass
+
+
+def measure(stream, reader, frames):
+    timings = []
+    for data in frames:
+        start = time.time()
+        stream.write(data)
+        reader.read_frame()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.95)] * 1000
+
+
+def main(paths):
+    frames = [encode(frame) for frame in workload(paths)]
+    ping = [encode({'command': 'ping'})] * ROUNDS
+    transports = [('pipe', _PipeConnection), ('tcp', _TCPConnection)]
+    if _UnixConnection:
+        transports.append(('unix', _UnixConnection))
+    print("%d frames (%d bytes)" % (len(frames), sum(len(f) for f in frames)))
+    print("%-6s %12s %12s %12s %12s" % ("mode", "ping p50 ms", "ping p95 ms", "frame p50 ms", "frame p95 ms"))
+    for name, cls in transports:
+        conn = cls()
+        process = multiprocessing.Process(target=peer, args=(conn.get_commandline_args(),))
+        process.start()
+        stream = conn.get_stream()
+        conn.cleanup()
+        reader = _FrameReader(stream)
+        ping_p50, ping_p95 = measure(stream, reader, ping)
+        frame_p50, frame_p95 = measure(stream, reader, frames * max(1, ROUNDS // len(frames) // 10))
+        print("%-6s %12.3f %12.3f %12.3f %12.3f" % (name, ping_p50, ping_p95, frame_p50, frame_p95))
+        if hasattr(stream, 'close'):
+            stream.close()
+        process.terminate()
+        process.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
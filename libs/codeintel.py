@@ -28,13 +28,21 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
 import os
+import re
 import sys
 
 import json
 import time
+import codecs
 import threading
 import logging
+import zlib
+import mmap
 import socket
+import heapq
+import hashlib
+import itertools
+import collections
 import weakref
 import functools
 from distutils.spawn import find_executable
@@ -44,6 +52,8 @@ try:
 except ImportError:
     import Queue as queue
 
+from . import umsgpack
+
 # Priorities at which scanning requests can be scheduled.
 PRIORITY_CONTROL = 0        # Special sentinal priority to control scheduler
 PRIORITY_IMMEDIATE = 1      # UI is requesting info on this file now
@@ -57,6 +67,8 @@ logger_level = logging.INFO  # INFO
 logger = logging.getLogger(logger_name)
 logger.setLevel(logger_level)
 
+_utf8_decode = codecs.getdecoder('utf-8')  # decodes straight from memoryviews
+
 
 class CodeIntel(object):
     def __init__(self, main_thread_runner):
@@ -68,8 +80,15 @@ class CodeIntel(object):
         self.log = logging.getLogger(logger_name + '.' + self.__class__.__name__)
         self.mgr = None
         self._mgr_lock = threading.Lock()
+        self._shards = {}  # keyed by shard name; value is the manager of the shard (besides the main one)
+        self._shard_languages = None  # True for a shard per language, or mapping of language to shard name
+        self._max_processes = 0  # managers running at most, main one included (0 for no limit)
+        self._scan_worker = None  # manager of the background scans (see scan_worker in activate())
+        self._scan_worker_enabled = False
+        self._manager_options = {}  # activate() arguments, to start shards as needed
         self.buffers = {}
         self.languages = {}
+        self.completion_cache = _CompletionCache()
         self._queue = queue.Queue()
         self._quit_application = False  # app is shutting down, don't try to respawn
         self._observers = weakref.WeakKeyDictionary()
@@ -80,7 +99,8 @@ class CodeIntel(object):
             self._observers[obj] = True
 
     def notify_observers(self, topic, data):
-        """Observer calls must be called on the main thread"""
+        """Observers are called on a background thread; they must proxy
+        anything touching the UI to the main thread"""
         if topic:
             for obj in self._observers.keys():
                 obj.observer(topic, data)
@@ -111,11 +131,20 @@ class CodeIntel(object):
 
     def _on_mgr_shutdown(self, mgr):
         # The codeintel manager is going away, drop the reference to it
+        # (shards are started again by the next request for them)
         with self._mgr_lock:
             if self.mgr is mgr:
                 self.mgr = None
-
-    def activate(self, reset_db_as_necessary=False, codeintel_command=None, oop_mode=None, log_levels=None, env=None, prefs=None):
+            for name, shard in list(self._shards.items()):
+                if shard is mgr:
+                    del self._shards[name]
+            if self._scan_worker is mgr:
+                self._scan_worker = None
+        for buf in list(self.buffers.values()):
+            if buf.mgr is mgr:
+                buf.mgr = None
+
+    def activate(self, reset_db_as_necessary=False, codeintel_command=None, oop_mode=None, log_levels=None, env=None, prefs=None, capabilities=None, compression_threshold=None, batch_max_bytes=None, batch_max_latency=None, engine=None, in_flight_window=None, hot_standby=None, shards=None, max_processes=None, scan_worker=None):
         self.log.debug("activating codeintel service")
 
         if self._quit_application:
@@ -125,31 +154,42 @@ class CodeIntel(object):
         with self._mgr_lock:
             if self.mgr and not self.mgr.is_alive():
                 self.mgr = None
+            self._manager_options = dict(
+                reset_db_as_necessary=reset_db_as_necessary,
+                engine=engine,
+                codeintel_command=codeintel_command,
+                oop_mode=oop_mode,
+                log_levels=log_levels,
+                env=env,
+                prefs=prefs,
+                capabilities=capabilities,
+                compression_threshold=compression_threshold,
+                batch_max_bytes=batch_max_bytes,
+                batch_max_latency=batch_max_latency,
+                in_flight_window=in_flight_window,
+                hot_standby=hot_standby,
+            )
+            self._shard_languages = shards
+            self._max_processes = max_processes or 0
+            self._scan_worker_enabled = bool(scan_worker) and oop_mode != 'server'
             # create a new manager as necessary
-            if not self.mgr:
-                self.mgr = CodeIntelManager(
-                    self,
-                    progress_callback=self._on_mgr_progress,
-                    shutdown_callback=self._on_mgr_shutdown,
-                    codeintel_command=codeintel_command,
-                    oop_mode=oop_mode,
-                    log_levels=log_levels,
-                    env=env,
-                    prefs=prefs,
-                )
-                while True:
-                    try:
-                        # Tell the manager to deal with it; note that this request
-                        # will get queued by the manager for now, since we haven't
-                        # actually started the manager.
-                        self.mgr.send(**self._queue.get(False))
-                    except queue.Empty:
-                        break  # no more items
-
-                # new codeintel manager; update all the buffers to use this new one
-                for buf in list(self.buffers.values()):
-                    buf.mgr = self.mgr
+            new_mgr = not self.mgr
+            if new_mgr:
+                self.mgr = self._new_manager()
             self._enabled = True
+        if new_mgr:
+            while True:
+                try:
+                    # Tell the manager to deal with it; note that this request
+                    # will get queued by the manager for now, since we haven't
+                    # actually started the manager.
+                    kwargs = self._queue.get(False)
+                except queue.Empty:
+                    break  # no more items
+                self._mgr_for_request(kwargs).send(**kwargs)
+
+            # new codeintel manager; update all the buffers to use this new one
+            self._bind_buffers()
         try:
             # run the new manager
             self.mgr.start(reset_db_as_necessary)
@@ -157,22 +197,120 @@ class CodeIntel(object):
             # thread already started
             pass
 
+    def _new_manager(self, **overrides):
+        options = dict(self._manager_options, **overrides)
+        options.pop('reset_db_as_necessary')
+        return get_manager_class(options.pop('engine'))(
+            self,
+            progress_callback=self._on_mgr_progress,
+            shutdown_callback=self._on_mgr_shutdown,
+            **options
+        )
+
+    def _shard_name(self, lang):
+        """Return the name of the shard serving the language (None for the
+        main manager)"""
+        shards = self._shard_languages
+        if not shards or not lang:
+            return None
+        if shards is True:
+            return lang
+        return shards.get(lang)
+
+    def mgr_for(self, lang):
+        """Return the manager serving the language: the one of its shard
+        (started as needed, within the max_processes budget) or the main one"""
+        name = self._shard_name(lang)
+        if name is None:
+            return self.mgr
+        with self._mgr_lock:
+            if not self.mgr:
+                return None
+            mgr = self._shards.get(name)
+            if mgr is not None:
+                return mgr
+            if self._max_processes and len(self.managers) >= self._max_processes:
+                return self.mgr  # out of budget, the main manager serves it
+            self.log.debug("starting codeintel shard %s", name)
+            mgr = self._shards[name] = self._new_manager()
+        self._bind_buffers(name)
+        mgr.start(self._manager_options.get('reset_db_as_necessary', False))
+        return mgr
+
+    def scan_worker(self):
+        """Return the manager of the background scans (started as needed,
+        within the max_processes budget), or None to scan in the manager of
+        the language"""
+        if not self._scan_worker_enabled:
+            return None
+        with self._mgr_lock:
+            if not self.mgr:
+                return None
+            mgr = self._scan_worker
+            if mgr is not None:
+                return mgr
+            if self._max_processes and len(self.managers) >= self._max_processes:
+                return None
+            self.log.debug("starting codeintel scan worker")
+            # (a spare child isn't worth it for scans, they're replayed on restart anyway)
+            mgr = self._scan_worker = self._new_manager(low_priority=True, hot_standby=False)
+        mgr.start(self._manager_options.get('reset_db_as_necessary', False))
+        return mgr
+
+    def _mgr_for_request(self, kwargs):
+        if kwargs.get('command') == 'scan-document' and kwargs.get('priority', PRIORITY_CURRENT) >= PRIORITY_OPEN:
+            mgr = self.scan_worker()
+            if mgr:
+                return mgr
+        lang = kwargs.get('language')
+        if lang is None:
+            buf = self.buffers.get(kwargs.get('vid'))
+            lang = buf and buf.lang
+        return self.mgr_for(lang)
+
+    def _bind_buffers(self, name=None):
+        """Update the buffers (of the shard, or all of them) to use their
+        current manager"""
+        for buf in list(self.buffers.values()):
+            shard_name = self._shard_name(buf.lang)
+            if name is None or shard_name == name:
+                buf.mgr = self._shards.get(shard_name) or self.mgr
+
+    @property
+    def managers(self):
+        """The main manager, the ones of the shards and the scan worker"""
+        return [mgr for mgr in [self.mgr] + list(self._shards.values()) + [self._scan_worker] if mgr]
+
     @property
     def enabled(self):
         return self._enabled and self.mgr and self.mgr.is_alive()
 
     def deactivate(self):
         with self._mgr_lock:
-            if self.mgr:
-                self.mgr.shutdown()
-                self.mgr = None
+            managers = self.managers
+            self.mgr = None
+            self._shards.clear()
+            self._scan_worker = None
+        for mgr in managers:
+            mgr.shutdown()
         self._enabled = False
 
     def cancel(self):
-        mgr = self.mgr
-        if mgr:
+        for mgr in self.managers:
             mgr.abort()
 
+    def set_global_environment(self, env, prefs):
+        for mgr in self.managers:
+            mgr.set_global_environment(env=env, prefs=prefs)
+
+    def forget_view(self, vid):
+        for mgr in self.managers:
+            mgr.forget_view(vid)
+
+    def forget_text(self, path):
+        for mgr in self.managers:
+            mgr.forget_text(path)
+
     def is_cpln_lang(self, language):
         return language in self.get_cpln_langs()
 
@@ -204,13 +342,32 @@ class CodeIntel(object):
             self.log.warn("send called when not enabled (ignoring command) %r", kwargs)
             return
         if self.mgr:
-            self.mgr.send(**kwargs)
+            self._mgr_for_request(kwargs).send(**kwargs)
         elif not discardable:
             self._queue.put(kwargs)
             self.activate()
         else:
             self.log.debug("discarding request %r", kwargs)
 
+    def send_batch(self, requests, discardable=False):
+        """Send several requests (dicts of the arguments for send()) at once,
+        like queries for every selection of a view"""
+        if not self._enabled:
+            self.log.warn("send_batch called when not enabled (ignoring commands) %r", requests)
+            return
+        if self.mgr:
+            batches = collections.OrderedDict()
+            for kwargs in requests:
+                batches.setdefault(self._mgr_for_request(kwargs), []).append(kwargs)
+            for mgr, batch in batches.items():
+                mgr.send_batch(batch)
+        elif not discardable:
+            for kwargs in requests:
+                self._queue.put(kwargs)
+            self.activate()
+        else:
+            self.log.debug("discarding requests %r", requests)
+
     def collectReports(self, callback, closure):
         def on_have_report(request, response):
             for path, data in list(response.get('memory', {}).items()):
@@ -245,6 +402,37 @@ class CodeIntel(object):
         return None
 
 
+def _sendmsg_all(sock, bufs):
+    """Send all the buffers with a single vectored call (when possible)"""
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(bufs))
+        return
+    sent = sock.sendmsg(bufs)
+    if sent < sum(len(buf) for buf in bufs):
+        sock.sendall(memoryview(b''.join(bufs))[sent:])
+
+
+def _process_exited(proc):
+    """Whether the child process exited (returncode is set by whoever waits
+    for it, poll() can't tell while another thread is waiting)"""
+    if proc.returncode is not None:
+        return True
+    return hasattr(proc, 'poll') and proc.poll() is not None
+
+
+def _writev_all(fd, bufs):
+    """Write all the buffers to fd with a single vectored call (when possible)"""
+    if hasattr(os, 'writev'):
+        written = os.writev(fd, bufs)
+        if written == sum(len(buf) for buf in bufs):
+            return
+        data = memoryview(b''.join(bufs))[written:]
+    else:
+        data = memoryview(b''.join(bufs))
+    while data:
+        data = data[os.write(fd, data):]
+
+
 class _Connection(object):
     def get_commandline_args(self):
         """Return list of command line args to pass to child"""
@@ -254,6 +442,20 @@ class _Connection(object):
         """Return file-like object for read/write"""
         raise NotImplementedError()
 
+    def readinto(self, b):
+        """Read into the writable buffer b, return the number of bytes read"""
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def writev(self, bufs):
+        """Write all the buffers (at once, when possible)"""
+        self.write(b''.join(bufs))
+
+    def get_socket(self):
+        """Return the connected socket (None if not socket based)"""
+        return None
+
     def cleanup(self):
         """Do any cleanup required"""
 
@@ -261,6 +463,7 @@ class _Connection(object):
 class _TCPConnection(_Connection):
     """A connection using TCP sockets"""
 
+    _conn = None
     _read = None
     _write = None
 
@@ -275,6 +478,7 @@ class _TCPConnection(_Connection):
 
     def get_stream(self):
         conn = self.sock.accept()
+        self._conn = conn[0]
         self._read = conn[0].makefile('rb', 0)
         self._write = conn[0].makefile('wb', 0)
         return self
@@ -282,9 +486,18 @@ class _TCPConnection(_Connection):
     def read(self, count):
         return self._read.read(count)
 
+    def readinto(self, b):
+        return self._conn.recv_into(b)
+
+    def writev(self, bufs):
+        _sendmsg_all(self._conn, bufs)
+
     def write(self, data):
         return self._write.write(data)
 
+    def get_socket(self):
+        return self._conn
+
     def cleanup(self):
         if self.sock:
             self.sock.close()
@@ -314,14 +527,100 @@ class _ServerConnection(_Connection):
     def read(self, count):
         return self._read.read(count)
 
+    def readinto(self, b):
+        return self.sock.recv_into(b)
+
+    def writev(self, bufs):
+        _sendmsg_all(self.sock, bufs)
+
     def write(self, data):
         return self._write.write(data)
 
+    def get_socket(self):
+        return self.sock
+
     def cleanup(self):
         if self.sock:
             self.sock.close()
 
 
+if hasattr(socket, 'AF_UNIX'):
+    class _UnixConnection(_Connection):
+        """A connection using a Unix domain socket"""
+
+        _dir = None
+        _conn = None
+        _read = None
+        _write = None
+
+        child = None  # the process expected to connect (see get_stream)
+
+        def __init__(self):
+            import tempfile
+            self._dir = tempfile.mkdtemp(prefix='codeintel-', suffix='-oop-socket')
+            self.path = os.path.join(self._dir, 'socket')
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            self.sock.listen(0)
+
+        def get_commandline_args(self):
+            return ['--unix', self.path]
+
+        def get_stream(self):
+            # give up if the child exits instead of connecting (codeintel
+            # versions without --unix exit on the unknown option)
+            self.sock.settimeout(0.5)
+            while True:
+                try:
+                    conn = self.sock.accept()
+                    break
+                except socket.timeout:
+                    if self.child is not None and _process_exited(self.child):
+                        raise IOError("OOP CodeIntel exited before connecting")
+            conn[0].settimeout(None)
+            self._conn = conn[0]
+            self._read = conn[0].makefile('rb', 0)
+            self._write = conn[0].makefile('wb', 0)
+            return self
+
+        def read(self, count):
+            return self._read.read(count)
+
+        def readinto(self, b):
+            return self._conn.recv_into(b)
+
+        def writev(self, bufs):
+            _sendmsg_all(self._conn, bufs)
+
+        def write(self, data):
+            return self._write.write(data)
+
+        def get_socket(self):
+            return self._conn
+
+        def cleanup(self):
+            # the accepted connection is kept open, but the listening socket
+            # and its filesystem entry are no longer needed.
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            try:
+                os.rmdir(self._dir)
+            except OSError:
+                pass
+
+        def close(self):
+            self.cleanup()
+            if self._conn:
+                self._conn.close()
+else:
+    _UnixConnection = None
+
+
 if sys.platform.startswith("win"):
     from .win32_named_pipe import Win32Pipe
 
@@ -387,9 +686,19 @@ else:
         def read(self, count):
             return self._read.read(count)
 
+        def readinto(self, b):
+            return self._read.readinto(b)
+
+        def writev(self, bufs):
+            _writev_all(self._write.fileno(), bufs)
+
         def write(self, data):
             return self._write.write(data)
 
+        def get_files(self):
+            """Return the (read, write) file objects of the pipes"""
+            return self._read, self._write
+
         def cleanup(self):
             # don't close the streams here, but remove the files.  The fds are
             # left open so we can communicate through them, but we no longer
@@ -417,6 +726,701 @@ else:
     CODEINTEL_SUBPATHS = ('bin',)
 
 
+def _common_prefix_length(a, b, limit):
+    """Length of the common prefix of a and b (up to limit); uses binary
+    search over slice comparisons so the work is done in C"""
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix_length(a, b, limit):
+    """Length of the common suffix of a and b (up to limit)"""
+    len_a, len_b = len(a), len(b)
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len_a - mid:len_a - lo] == b[len_b - mid:len_b - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _text_changes(old, new):
+    """Return the list of edited ranges which turn the text old into new.
+    Each change is a dict with the 'start' and 'end' character offsets (in
+    old) of the replaced range and the replacement 'text'."""
+    if old == new:
+        return []
+    limit = min(len(old), len(new))
+    prefix = _common_prefix_length(old, new, limit)
+    suffix = _common_suffix_length(old, new, limit - prefix)
+    return [{
+        'start': prefix,
+        'end': len(old) - suffix,
+        'text': new[prefix:len(new) - suffix],
+    }]
+
+
+class _SharedTexts(object):
+    """Memory-mapped files (one per view) used to hand big texts to the
+    child without copying them through the pipe.
+
+    Every text is written at an offset no request still in flight for the
+    same view uses; the space is reclaimed once the request is released.
+    A file left much bigger than the text being stored (after a burst of
+    requests or a text that got smaller) is recreated with the right size
+    once no request uses it.
+    """
+
+    SHRINK_RATIO = 4  # files this many times bigger than needed are recreated
+    MIN_SIZE = 1 << 20  # (smaller files are always kept)
+
+    def __init__(self):
+        self._dir = None
+        self._files = {}  # keyed by vid; value is list [path, mmap, {req_id: (start, end)}]
+        self._vids = {}  # keyed by request id; value is the vid
+        self._lock = threading.Lock()
+
+    def put(self, vid, req_id, data):
+        """Store data for the request, return tuple (file name, offset)"""
+        with self._lock:
+            if self._dir is None:
+                import tempfile
+                shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+                self._dir = tempfile.mkdtemp(prefix='codeintel-', suffix='-oop-shm', dir=shm_dir)
+            try:
+                path, mm, used = self._files[vid]
+            except KeyError:
+                path, mm, used = os.path.join(self._dir, 'view-%s' % vid), None, {}
+                self._files[vid] = [path, mm, used]
+            if mm is not None and not used and len(mm) > self.SHRINK_RATIO * max(len(data), self.MIN_SIZE):
+                # a new file rather than truncating this one under the child
+                mm.close()
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                mm = self._files[vid][1] = None
+            offset = max([end for start, end in used.values()] or [0])
+            size = offset + len(data)
+            if mm is None or len(mm) < size:
+                if mm is not None:
+                    size = max(size, 2 * len(mm))
+                    mm.close()
+                with open(path, 'ab+') as fp:
+                    fp.truncate(size)
+                    fp.flush()
+                    mm = mmap.mmap(fp.fileno(), 0)
+                self._files[vid][1] = mm
+            mm[offset:offset + len(data)] = data
+            used[req_id] = (offset, offset + len(data))
+            self._vids[req_id] = vid
+            return path, offset
+
+    def release(self, req_id):
+        """The child is done with the text of the request"""
+        with self._lock:
+            vid = self._vids.pop(req_id, None)
+            if vid is not None:
+                self._files[vid][2].pop(req_id, None)
+
+    def discard(self, vid):
+        """Remove the file of a view (closed)"""
+        with self._lock:
+            path, mm, used = self._files.pop(vid, (None, None, {}))
+            for req_id in used:
+                self._vids.pop(req_id, None)
+            if mm is not None:
+                mm.close()
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def close(self):
+        for vid in list(self._files):
+            self.discard(vid)
+        if self._dir:
+            try:
+                os.rmdir(self._dir)
+            except OSError:
+                pass
+            self._dir = None
+
+
+class _MetadataCache(object):
+    """Results of the initial requests (language lists, completion
+    characters and catalogs) kept on disk, keyed by the codeintel executable
+    and its modification time, so a new manager can serve buffers before the
+    child answers them again.
+    """
+
+    fields = ('citadel_langs', 'xml_langs', 'stdlib_langs', 'cpln_langs', 'languages', 'available_catalogs')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(command):
+        try:
+            return "%s:%s" % (command, os.path.getmtime(command))
+        except (TypeError, OSError):
+            return None  # no executable (server oop mode?)
+
+    def _read(self):
+        try:
+            with codecs.open(self.path, 'r', 'utf-8') as fp:
+                entries = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def load(self, command):
+        """Return the metadata cached for command (None if there is none or
+        the executable changed since)"""
+        key = self._key(command)
+        if key is None:
+            return None
+        with self._lock:
+            metadata = self._read().get(key)
+        if not isinstance(metadata, dict) or any(field not in metadata for field in self.fields):
+            return None
+        return metadata
+
+    def save(self, command, metadata):
+        """Store the metadata for command (replacing what was stored for any
+        other version of the executable)"""
+        key = self._key(command)
+        if key is None:
+            return
+        with self._lock:
+            entries = self._read()
+            if entries.get(key) == metadata:
+                return
+            for old_key in list(entries):
+                if old_key.rsplit(':', 1)[0] == command:
+                    del entries[old_key]
+            entries[key] = metadata
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+            with codecs.open(tmp_path, 'w', 'utf-8') as fp:
+                json.dump(entries, fp)
+            if hasattr(os, 'replace'):
+                os.replace(tmp_path, self.path)
+            else:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tmp_path, self.path)
+
+
+class _CompletionCache(object):
+    """LRU cache of the completions evaluated for triggers, keyed by
+    language, path and trigger position, so typing further into the name
+    being completed doesn't ask the child again: the cached completions are
+    refined by the typed prefix.
+
+    Entries remember the view's change count, text length and cursor (in
+    characters) when the completions were asked for; they're used as long
+    as the text is the same (same change count) or every change since typed
+    one more character of the name at the cursor, which is cheap to check
+    on each keystroke (nothing is hashed). Entries expire after ttl seconds,
+    and those of a file are dropped when it's scanned (its definitions may
+    have changed).
+    """
+
+    MAX_PREFIX = 64  # characters typed after the trigger that can still hit
+    _word_tail = re.compile(r'\w*\Z', re.UNICODE)
+
+    def __init__(self, size=64, ttl=30.0):
+        self.size = size  # entries kept at most (0 disables the cache)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # keyed by (lang, path, trigger pos); value is list [time stored, change count, text length, cursor, cplns, trg]
+        self._lock = threading.Lock()
+
+    def configure(self, size=None, ttl=None):
+        with self._lock:
+            if size is not None:
+                self.size = size
+            if ttl is not None:
+                self.ttl = ttl
+            self._trim()
+
+    def _trim(self):
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def store(self, lang, path, snapshot, trg, cplns):
+        """Keep the completions of the trigger; snapshot is the tuple (text,
+        change count, cursor) of the request the trigger was found for"""
+        text, change_count, cursor = snapshot
+        pos = trg.get('pos')
+        if not self.size or pos is None:
+            return
+        pos = len(text.encode('utf-8')[:pos].decode('utf-8', 'ignore'))  # (in characters)
+        if pos > cursor:
+            return
+        key = (lang, path, pos)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = [time.time(), change_count, len(text), cursor, cplns, trg]
+            self._trim()
+
+    def lookup(self, lang, path, text, change_count, cursor):
+        """Return tuple (cplns, trg) for a completion at the cursor, if the
+        name being typed there follows a cached trigger; cplns are the ones
+        starting with what was typed (in any case), or None on a miss"""
+        if not self.size or change_count is None:
+            return None
+        tail = self._word_tail.search(text, max(0, cursor - self.MAX_PREFIX), cursor)
+        start = tail.start() if tail else cursor
+        key = (lang, path, start)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                stored, stored_change_count, stored_length, stored_cursor, cplns, trg = entry
+                typed = cursor - stored_cursor
+                if stored_change_count != change_count and not (typed > 0 and change_count - stored_change_count == typed and len(text) - stored_length == typed):
+                    entry = None  # edited some other way since
+                else:
+                    entry[1:4] = [change_count, len(text), cursor]
+            else:
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # most recently used
+            self.hits += 1
+        prefix = text[start:cursor]
+        if prefix:
+            lower = prefix.lower()
+            cplns = [c for c in cplns if c[1].lower().startswith(lower)]
+        return cplns, trg
+
+    def invalidate(self, path):
+        """Drop the entries of the file"""
+        path = CodeIntelBuffer.normpath(path)
+        with self._lock:
+            for key in [key for key in self._entries if key[1] and CodeIntelBuffer.normpath(key[1]) == path]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _Standby(object):
+    """A spare child process, spawned and connected ahead of time (and its
+    handshake read) for the manager to switch to when the child dies."""
+
+    def __init__(self, mgr):
+        self.proc = None
+        self.pipe = None
+        self.reader = None
+        self.handshake = None
+        self.ready = threading.Event()
+        thread = threading.Thread(
+            target=self._start,
+            name="CodeIntel Standby Thread",
+            args=(mgr,),
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _start(self, mgr):
+        from . import process
+        conn = None
+        try:
+            conn = mgr._child_connection()
+            cmd = mgr._child_command(conn)
+            mgr.log.debug("Running standby OOP: %s", " ".join(cmd))
+            self.proc = conn.child = process.ProcessOpen(cmd, cwd=None, env=None)
+            self.pipe = conn.get_stream()
+            conn.cleanup()  # This will remove the filesystem files (it keeps the fds open)
+            self.reader = _FrameReader(self.pipe)
+            if mgr._capabilities:
+                # children supporting protocol extensions start with a handshake
+                handshake = _decode_frame(self.reader.read_frame())
+                if 'req_id' in handshake or 'command' in handshake:
+                    raise IOError("Unexpected frame instead of the handshake")
+                self.handshake = handshake
+            self.ready.set()
+        except Exception as e:
+            mgr.log.error("Error starting standby child: %s", e)
+            if conn:
+                try:
+                    conn.cleanup()
+                except Exception:
+                    pass
+            self.kill()
+
+    @property
+    def alive(self):
+        return self.ready.is_set() and self.proc is not None and self.proc.poll() is None
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except Exception:
+            pass
+        try:
+            self.pipe.close()
+        except Exception:
+            pass
+
+
+class _ResponseWorkers(object):
+    """Pool of background threads handling responses. All work for the same
+    key (request id) goes to the same thread, so it's done in order."""
+
+    def __init__(self, count, name):
+        self.name = name
+        self._queues = [queue.Queue() for i in range(count)]
+        self._threads = []
+
+    def start(self):
+        for i, work_queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work,
+                name="%s %d" % (self.name, i + 1),
+                args=(work_queue,),
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, fn):
+        self._queues[hash(key) % len(self._queues)].put(fn)
+
+    def stop(self):
+        for work_queue in self._queues:
+            work_queue.put(None)
+
+    def _work(self, work_queue):
+        while True:
+            fn = work_queue.get()
+            if fn is None:
+                break
+            try:
+                fn()
+            except Exception as e:
+                logger.exception("Error handling response: %s", e)
+
+
+class _RequestQueue(object):
+    """Queue of requests to send, by priority (see the PRIORITY_* constants).
+
+    Requests come out in priority order, and in arrival order within a
+    priority. Waiting requests age one priority level every `aging` seconds,
+    so a steady flow of urgent requests can't starve background ones;
+    PRIORITY_CONTROL always goes first. The time requests spend queued is
+    accumulated in stats, per priority. Same get()/put() interface as
+    queue.Queue (put() also takes the priority and request class).
+
+    Requests of a class (e.g. interactive or bulk) with a window only come
+    out while less than that many requests of the class are in flight (see
+    started() and finished()); the rest keep waiting in the queue.
+    """
+
+    def __init__(self, aging, stats, windows=None):
+        self.aging = aging
+        self.stats = stats
+        self.windows = windows or {}  # keyed by request class; value is the maximum in flight
+        self.in_flight = collections.defaultdict(int)  # keyed by request class
+        self._levels = {}  # keyed by (priority, request class); value is deque of (time queued, item)
+        self._changed = threading.Condition()
+
+    def put(self, item, priority=PRIORITY_CURRENT, request_class=None):
+        with self._changed:
+            self._levels.setdefault((priority, request_class), collections.deque()).append((time.time(), item))
+            self._changed.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._changed:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                now = time.time()
+                best = self._best(now)
+                if best is not None:
+                    break
+                remaining = None if deadline is None else deadline - now
+                if not block or remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._changed.wait(remaining)
+            queued, item = self._levels[best].popleft()
+            priority = best[0]
+            waited = now - queued
+            self.stats['queue_requests_p%d' % priority] += 1
+            self.stats['queue_time_p%d' % priority] += waited
+            if waited > self.stats['queue_max_time_p%d' % priority]:
+                self.stats['queue_max_time_p%d' % priority] = waited
+        return item
+
+    def _best(self, now):
+        """Return the key of the level to take the next request from"""
+        best = None
+        for key in sorted(self._levels, key=lambda key: key[0]):
+            level = self._levels[key]
+            priority, request_class = key
+            if not level:
+                continue
+            if priority == PRIORITY_CONTROL:
+                return key
+            window = self.windows.get(request_class)
+            if window and self.in_flight[request_class] >= window:
+                continue  # wait for some to finish
+            # the oldest request in the level is the most aged one
+            effective = priority - (now - level[0][0]) / self.aging
+            if best is None or effective < best_effective:
+                best, best_effective = key, effective
+        return best
+
+    def started(self, request_class):
+        """A request of the class was sent"""
+        with self._changed:
+            self.in_flight[request_class] += 1
+
+    def finished(self, request_class):
+        """A request of the class is no longer in flight"""
+        with self._changed:
+            self.in_flight[request_class] -= 1
+            self._changed.notify()
+
+    def gauges(self):
+        """Return the number of requests queued and in flight, by class"""
+        with self._changed:
+            queued = collections.defaultdict(int)
+            for (priority, request_class), level in self._levels.items():
+                queued[request_class] += len(level)
+            return {
+                'queued': dict(queued),
+                'in_flight': dict(self.in_flight),
+            }
+
+    def qsize(self):
+        with self._changed:
+            return sum(len(level) for level in self._levels.values())
+
+    def empty(self):
+        return not self.qsize()
+
+
+class _TimerHeap(object):
+    """Timers kept in a heap (by deadline) and fired, in order, by a single
+    background thread (started with the first timer); functions run in that
+    thread, so they must be quick. Cancelled timers drop their function
+    right away and are left in the heap (skipped when they come out) until
+    they're most of it, then the heap is compacted."""
+
+    COMPACT_MIN = 64  # cancelled timers before compacting is considered
+
+    def __init__(self, name):
+        self.name = name
+        self._heap = []  # of lists [deadline, sequence, function (None once cancelled or fired)]
+        self._cancelled = 0  # cancelled timers still in the heap
+        self._sequence = itertools.count()
+        self._changed = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def schedule(self, delay, fn):
+        """Call fn in delay seconds; returns the handle to cancel it"""
+        timer = [time.time() + delay, next(self._sequence), fn]
+        with self._changed:
+            if self._stopped:
+                return timer
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            heapq.heappush(self._heap, timer)
+            if self._heap[0] is timer:
+                self._changed.notify()  # new earliest deadline
+        return timer
+
+    def cancel(self, timer):
+        """Cancel the timer (if it didn't fire yet)"""
+        if timer is None:
+            return
+        with self._changed:
+            if timer[2] is None:
+                return  # already fired (or cancelled)
+            timer[2] = None
+            self._cancelled += 1
+            if self._cancelled >= self.COMPACT_MIN and self._cancelled * 2 > len(self._heap):
+                self._heap = [timer for timer in self._heap if timer[2] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def stop(self):
+        with self._changed:
+            self._stopped = True
+            del self._heap[:]
+            self._cancelled = 0
+            self._changed.notify()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._stopped:
+                    if not self._heap:
+                        self._changed.wait()
+                        continue
+                    timeout = self._heap[0][0] - time.time()
+                    if timeout <= 0:
+                        break
+                    self._changed.wait(timeout)
+                if self._stopped:
+                    break
+                timer = heapq.heappop(self._heap)
+                fn, timer[2] = timer[2], None
+                if fn is None:
+                    self._cancelled -= 1
+                    continue
+            try:
+                fn()
+            except Exception as e:
+                logger.exception("Error running timer: %s", e)
+
+
+def _chain_callbacks(*callbacks):
+    """Return a request callback calling all the given ones"""
+    callbacks = [callback for callback in callbacks if callback]
+    if len(callbacks) < 2:
+        return callbacks[0] if callbacks else None
+
+    def callback(request, response):
+        for callback in callbacks:
+            try:
+                callback(request, response)
+            except Exception as e:
+                logger.exception("Error calling request callback: %s", e)
+    return callback
+
+
+def _decode_frame(frame):
+    """Decode a JSON or MessagePack frame"""
+    if frame[0:1] == b'{':
+        return json.loads(_utf8_decode(frame)[0])
+    return umsgpack.loads(frame)
+
+
+class _FrameReader(object):
+    """Buffered reader which splits the OOP stream into frames.
+
+    Frames are a decimal length followed by the payload (which starts with
+    '{' for JSON, a map marker for MessagePack or 'x' for zlib compressed
+    payloads). Data is read with readinto() into a single reusable bytearray, so
+    one read can yield many frames, and every frame is returned as a
+    memoryview into that buffer (no copies); views are only valid until the
+    next call to read_frame().
+
+    Without a stream, data is fed() to the reader instead and the complete
+    frames are taken with pending_frames().
+    """
+
+    buffer_size = 64 * 1024
+
+    _whitespace = frozenset(bytearray(b' \t\r\n'))
+    _length_chars = frozenset(bytearray(b'0123456789 \t\r\n'))
+    _frame_starts = frozenset(bytearray(b'{x')) | umsgpack.MAP_MARKERS
+
+    def __init__(self, stream=None, buffer_size=None):
+        self.stream = stream
+        if buffer_size is not None:
+            self.buffer_size = buffer_size
+        self._buf = bytearray(self.buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # start of unparsed data
+        self._end = 0  # end of data read so far
+        self._need = 1  # bytes needed (from _start) to complete next frame
+
+    def read_frame(self):
+        """Return a memoryview over the next complete frame"""
+        while True:
+            frame = self._parse()
+            if frame is not None:
+                return frame
+            self._fill()
+
+    def feed(self, data):
+        """Append data to the buffer"""
+        self._make_room(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def pending_frames(self):
+        """Yield memoryviews over the complete frames in the buffer (each one
+        is only valid until the next one is taken)"""
+        while True:
+            frame = self._parse()
+            if frame is None:
+                return
+            yield frame
+
+    def _parse(self):
+        buf = self._buf
+        pos, end = self._start, self._end
+        while pos < end and buf[pos] in self._whitespace:
+            pos += 1
+        self._start = pos
+        while pos < end and buf[pos] in self._length_chars:
+            pos += 1
+        if pos == end:
+            # need more data to get the frame length
+            self._need = pos - self._start + 1
+            return None
+        if buf[pos] not in self._frame_starts:
+            raise ValueError("Invalid frame length character: %r" % buf[pos:pos + 1])
+        if pos == self._start:
+            raise ValueError("Missing frame length")
+        length = int(buf[self._start:pos].translate(None, b' \t\r\n'))
+        if end - pos < length:
+            # need more data to complete the frame
+            self._need = pos - self._start + length
+            return None
+        self._start = pos + length
+        self._need = 1
+        return self._view[pos:pos + length]
+
+    def _make_room(self, size):
+        """Make room in the buffer for the pending frame and size more bytes"""
+        pending = self._end - self._start
+        need = max(self._need, pending + size)
+        if len(self._buf) - self._start < need:
+            if need > len(self._buf) or not pending and len(self._buf) > self.buffer_size:
+                # (re)allocate, frames bigger than the buffer make it grow
+                buf = bytearray(max(need, self.buffer_size))
+                buf[:pending] = self._view[self._start:self._end]
+                self._buf = buf
+                self._view = memoryview(buf)
+            else:
+                # move the partial frame to the front of the buffer
+                self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+        elif not pending:
+            self._start = self._end = 0
+
+    def _fill(self):
+        """Read more data, making room in the buffer for the pending frame"""
+        self._make_room(1)
+        count = self.stream.readinto(self._view[self._end:])
+        if not count:
+            # nothing read, EOF
+            raise IOError("Failed to read from socket")
+        self._end += count
+
+
 class CodeIntelManager(threading.Thread):
     STATE_UNINITIALIZED = ("uninitialized",)  # not initialized
     STATE_CONNECTED = ("connected",)  # child process spawned, connection up; not ready
@@ -430,6 +1434,42 @@ class CodeIntelManager(threading.Thread):
     _codeintel_command = None
     _oop_mode = 'pipe'
     _log_levels = ['WARNING']
+    _capabilities = ()  # protocol extensions the client is willing to use
+    _compression_threshold = 16 * 1024  # compress frames of at least this size (zlib capability)
+    _compression_level = 1
+    _batch_max_bytes = 256 * 1024  # maximum size of coalesced writes
+    _batch_max_latency = 0  # seconds to wait for more requests to coalesce
+    _batch_max_frames = 512  # (keeps vectored writes within IOV_MAX)
+    _response_worker_count = 2  # threads handling responses (and running callbacks)
+    _shared_memory_threshold = 64 * 1024  # pass texts of at least this size in shared memory (shared-memory capability)
+    _request_timeout = 5 * 60  # seconds without news after which requests time out
+    _request_timeouts = {  # by command, seconds without news after which requests time out
+        'trg-from-pos': 10,
+        'eval': 10,
+        'complete-at-pos': 10,
+        'calltip-arg-range': 10,
+        'abort': 10,
+        'database-preload': 60 * 60,
+        'database-upgrade': 60 * 60,
+        'database-reset': 10 * 60,
+    }
+    _queue_aging = 2.0  # seconds for queued requests to age one priority level
+    _handshake_timeout = 2.0  # seconds to wait for the handshake before sending the initial requests anyway
+    _hot_standby = False  # whether to keep a spare child to switch to if the child dies
+    _low_priority = False  # whether to run the child at low CPU and IO priority (background scans)
+    _superseding_commands = ('trg-from-pos', 'eval', 'complete-at-pos', 'calltip-arg-range')  # newer requests (for a view) make older ones useless
+    _bulk_commands = ('scan-document', 'database-preload', 'database-upgrade', 'database-reset')  # requests of the bulk class
+    _replay_commands = (  # idempotent requests, resent if the child dies
+        'scan-document', 'trg-from-pos', 'eval', 'complete-at-pos', 'calltip-arg-range', 'buf-to-html', 'memory-report',
+        'set-environment', 'set-xml-catalogs', 'get-available-catalogs',
+    )
+    _init_commands = ('get-languages', 'get-language-info', 'database-info', 'database-preload', 'database-upgrade', 'database-reset')  # requests of the initialization, run again for every new child
+    _replay_max_attempts = 3  # times a request is resent before giving up on it
+    _replay_backoff = 0.5  # seconds before the second resend of a request; doubles with each one
+    _in_flight_window = {  # by request class, maximum requests sent and not yet completed (0 for no limit)
+        'interactive': 8,
+        'bulk': 2,
+    }
     _state = STATE_UNINITIALIZED
     _send_request_thread = None  # background thread to send unsent requests
     _reset_db_as_necessary = False  # whether to reset the db if it's broken
@@ -444,6 +1484,10 @@ class CodeIntelManager(threading.Thread):
     xml_langs = []
     stdlib_langs = []  # languages which support standard libraries
     available_catalogs = []  # see get-available-catalogs command
+    server_capabilities = frozenset()  # protocol extensions announced by the child
+    _init_token = None  # set while the initial requests wait for the handshake
+    _standby = None  # spare child (see _Standby)
+    _standby_reader = None  # frame reader of the standby just switched to
     env = dict(os.environ)
     prefs = [
         {
@@ -469,12 +1513,12 @@ class CodeIntelManager(threading.Thread):
         },
     ]
 
-    def __init__(self, service, progress_callback=None, shutdown_callback=None, codeintel_command=None, oop_mode=None, log_levels=None, env=None, prefs=None):
+    def __init__(self, service, progress_callback=None, shutdown_callback=None, codeintel_command=None, oop_mode=None, log_levels=None, env=None, prefs=None, capabilities=None, compression_threshold=None, batch_max_bytes=None, batch_max_latency=None, in_flight_window=None, hot_standby=None, low_priority=None):
         self.log = logging.getLogger(logger_name + '.' + self.__class__.__name__)
         self.service = service
         self.languages = service.languages
         self._abort = set()
-        self._next_id = 0
+        self._ids = itertools.count()  # request ids (next() on it is atomic, requests are sent from several threads)
         self._progress_callback = progress_callback
         self._shutdown_callback = shutdown_callback
         if codeintel_command is not None:
@@ -483,14 +1527,47 @@ class CodeIntelManager(threading.Thread):
             self._oop_mode = oop_mode
         if log_levels is not None:
             self._log_levels = log_levels
+        if capabilities is not None:
+            self._capabilities = capabilities
+        if compression_threshold is not None:
+            self._compression_threshold = compression_threshold
+        if batch_max_bytes is not None:
+            self._batch_max_bytes = batch_max_bytes
+        if batch_max_latency is not None:
+            self._batch_max_latency = batch_max_latency / 1000.0
+        if in_flight_window is not None:
+            self._in_flight_window = dict(self._in_flight_window, **in_flight_window)
+        if hot_standby is not None:
+            self._hot_standby = hot_standby
+        if low_priority is not None:
+            self._low_priority = low_priority
         if prefs is not None:
             self.prefs = [prefs] if isinstance(prefs, dict) else prefs
         if env is not None:
             self.env = env
         self._state_condvar = threading.Condition()
-        self._discard_time = time.time()
+        self._write_lock = threading.Lock()
         self.requests = {}  # keyed by request id; value is tuple (callback, request data, time sent) requests will time out at some point...
-        self.unsent_requests = queue.Queue()
+        self._request_payloads = {}  # keyed by request id; text and env dropped from the request data, kept in case it must be resent (until it's answered or superseded)
+        self._synced_texts = {}  # keyed by path; value is tuple (text version, text) last sent to the child
+        self._text_refs = {}  # keyed by path; value is tuple (text ref, text) last sent to the child
+        self._init_lock = threading.Lock()
+        self._supersession_lock = threading.Lock()
+        self._latest_requests = {}  # keyed by supersession key; value is the newest request data queued
+        self._running_requests = {}  # keyed by supersession key; value is the id of the request sent
+        self._superseded = set()  # ids of the requests aborted because newer ones superseded them
+        self._pending_replays = set()  # ids of the requests waiting (for their backoff) to be resent
+        self._replays_lock = threading.Lock()  # (replays are scheduled and come due in different threads)
+        self._scans_lock = threading.Lock()
+        self._pending_scans = {}  # keyed by path; value is tuple (callback, request data) of the scan queued
+        self.stats = collections.defaultdict(int)  # counters, for tuning
+        self._latencies = {}  # keyed by command; value is the (moving) average round trip time
+        self._shared_texts = _SharedTexts()
+        self._response_workers = _ResponseWorkers(self._response_worker_count, "CodeIntel Response Worker")
+        self._timers = _TimerHeap("CodeIntel Request Timer Thread")
+        self._timeout_timers = {}  # keyed by request id; value is the handle of its timeout timer
+        self._metadata_cache = _MetadataCache(os.path.join(os.path.expanduser('~/.codeintel'), 'metadata.json'))
+        self.unsent_requests = _RequestQueue(self._queue_aging, self.stats, self._in_flight_window)
         threading.Thread.__init__(self, name="CodeIntel Manager Thread")
 
     @property
@@ -506,11 +1583,13 @@ class CodeIntelManager(threading.Thread):
     def start(self, reset_db_as_necessary=False):
         self._reset_db_as_necessary = reset_db_as_necessary
         threading.Thread.start(self)
+        self._response_workers.start()
 
     def shutdown(self):
         """Abort any outstanding requests and shut down gracefully"""
         if self.state is CodeIntelManager.STATE_DESTROYED:
             return  # already dead
+        self._stop_standby()
         self.abort()
         self.quit()
         if not self.pipe:
@@ -525,6 +1604,7 @@ class CodeIntelManager(threading.Thread):
             self.send(
                 command='abort',
                 id=req,
+                priority=PRIORITY_IMMEDIATE,
                 callback=lambda request, response: None,
             )
 
@@ -550,19 +1630,50 @@ class CodeIntelManager(threading.Thread):
                 return
             # It's destroying time.
             self.state = CodeIntelManager.STATE_DESTROYED
+        self._stop_standby()
         try:
             self.proc.kill()
         except Exception as e:
             pass
         self.close()
+        self._shared_texts.close()
+        self._response_workers.stop()
+        self._timers.stop()
         try:
             # Shut down the request sending thread (self._send_request_thread)
-            self.unsent_requests.put((None, None))
+            self._queue_request(None, None)
         except Exception as e:
             pass  # umm... no idea?
         if self._shutdown_callback:
             self._shutdown_callback(self)
 
+    def has_capability(self, capability):
+        """Whether a protocol extension is enabled and supported by the child"""
+        return capability in self._capabilities and capability in self.server_capabilities
+
+    def _warm_start(self):
+        """Take the results of the initial requests from the cache (when the
+        executable didn't change since they were stored), so buffers work
+        right away; the initial requests still run to revalidate them."""
+        if self.languages:
+            return  # already known
+        metadata = self._metadata_cache.load(self.find_command())
+        if metadata is None:
+            return
+        self.log.debug("warm start with cached language metadata")
+        for field in _MetadataCache.fields:
+            if field == 'languages':
+                self.languages.update(metadata['languages'])
+            else:
+                setattr(self, field, metadata[field])
+
+    def _save_metadata(self):
+        metadata = dict((field, getattr(self, field)) for field in _MetadataCache.fields)
+        try:
+            self._metadata_cache.save(self.find_command(), metadata)
+        except Exception as e:
+            self.log.error("Error saving the language metadata cache: %s", e)
+
     def find_command(self):
         codeintel_command = self._codeintel_command
         if codeintel_command:
@@ -588,40 +1699,26 @@ class CodeIntelManager(threading.Thread):
         from . import process
         assert threading.current_thread().name != "MainThread", \
             "CodeIntelManager.init_child should run on background thread!"
+        standby = self._take_standby()
+        if standby:
+            self._switch_to_standby(standby)
+            return
         self.log.debug("initializing child process")
         conn = None
+        self._reset_protocol_state()
+        self._replay_requests()  # (queued until the new child is ready)
         try:
-            codeintel_command = self.find_command()
-            cmd = [codeintel_command]
-
-            database_dir = os.path.expanduser('~/.codeintel')
-            cmd += ['--log-file', os.path.join(database_dir, 'codeintel.log')]
-            for log_level in self._log_levels:
-                cmd += ['--log-level', log_level]
-
-            cmd += ['oop']
-
-            cmd += ['--database-dir', database_dir]
-            _oop_mode = self._oop_mode
-            if _oop_mode == 'pipe':
-                conn = _PipeConnection()
-            elif _oop_mode == 'tcp':
-                conn = _TCPConnection()
-            elif _oop_mode == 'server':
-                conn = _ServerConnection()
-            else:
-                self.log.warn("Unknown codeintel oop mode %s, falling back to pipes", _oop_mode)
-                conn = _PipeConnection()
-            cmd += conn.get_commandline_args()
+            conn = self._child_connection()
+            cmd = self._child_command(conn)
 
-            if _oop_mode == 'server':
+            if self._oop_mode == 'server':
                 if self._cmd_messge:
                     self._cmd_messge = False
                     self.log.warn("Please start OOP server with command: %s", " ".join(cmd))
                 self.proc = True
             else:
                 self.log.debug("Running OOP: %s", " ".join(cmd))
-                self.proc = process.ProcessOpen(cmd, cwd=None, env=None)
+                self.proc = conn.child = process.ProcessOpen(cmd, cwd=None, env=None)
                 assert self.proc.returncode is None, "Early process death!"
 
                 self._watchdog_thread = threading.Thread(
@@ -637,17 +1734,166 @@ class CodeIntelManager(threading.Thread):
                 self.log.info("Successfully connected with OOP CodeIntel!")
             except Exception:
                 self.pipe = None
+                self._check_oop_mode()
 
             conn.cleanup()  # This will remove the filesystem files (it keeps the fds open)
 
             self.state = CodeIntelManager.STATE_CONNECTED
         except Exception as e:
+            if conn:
+                try:
+                    conn.cleanup()  # don't leave pipes or sockets behind
+                except Exception:
+                    pass
             self.kill()
             message = "Error initing child: %s" % e
             self.log.error(message)
             self._progress_callback(self, message)
         else:
-            self._send_init_requests()
+            self._schedule_init_requests()
+
+    def _reset_protocol_state(self):
+        """Forget what was negotiated with (and sent to) the previous child
+        (the requests it didn't answer are left for _replay_requests)"""
+        self.server_capabilities = frozenset()
+        self._init_token = None
+        self._synced_texts.clear()
+        self._text_refs.clear()
+
+    def _expire_lost_request(self, req_id, callback, request, message):
+        # no answer is coming (and they'd hold their in-flight window)
+        self._response_workers.submit(req_id, functools.partial(
+            self._expire_request, req_id, callback, request, message))
+
+    def _replay_requests(self):
+        """Send the requests the previous child didn't answer to the new one.
+        Only idempotent requests (see _replay_commands) are resent; evals
+        included, as long as no newer request for the view superseded them
+        (the text they were triggered on is unchanged). Each request is
+        resent up to _replay_max_attempts times, waiting longer each time (in
+        case the request is what kills the child). Requests of the
+        initialization are dropped (their callbacks aren't called), it's done
+        again for the new child. The rest fail right away."""
+        for req_id, (callback, request, sent_time) in list(self.requests.items()):
+            with self._replays_lock:
+                pending = req_id in self._pending_replays
+            if pending:
+                continue  # already waiting to be resent
+            attempts = request.get('replays', 0)
+            if request.get('command') in self._init_commands:
+                self.log.debug("Dropping initial request %s (command %s)", req_id, request.get('command'))
+                self._forget_request(req_id)
+            elif request.get('command') not in self._replay_commands:
+                self.stats['replays_failed'] += 1
+                self._expire_lost_request(req_id, callback, request, "OOP CodeIntel process died, request not retried")
+            elif attempts >= self._replay_max_attempts:
+                self.stats['replays_failed'] += 1
+                self._expire_lost_request(req_id, callback, request, "OOP CodeIntel process died, request retried %d times" % attempts)
+            else:
+                self.stats['replays'] += 1
+                delay = self._replay_backoff * (2 ** attempts - 1)
+                if delay:
+                    with self._replays_lock:
+                        self._pending_replays.add(req_id)
+                    self._call_later(delay, functools.partial(self._replay_due, req_id, callback, request, attempts + 1))
+                else:
+                    self._resend_request(req_id, callback, request, replays=attempts + 1)
+
+    def _replay_due(self, req_id, callback, request, replays):
+        with self._replays_lock:
+            self._pending_replays.discard(req_id)
+        if req_id not in self.requests:
+            return  # timed out (or forgotten) meanwhile
+        self._resend_request(req_id, callback, request, replays=replays)
+
+    def _start_standby(self):
+        """Spawn a spare child in the background (with hot_standby)"""
+        if not self._hot_standby or self._oop_mode == 'server' or self._standby:
+            return
+        if self.state in (CodeIntelManager.STATE_QUITTING, CodeIntelManager.STATE_DESTROYED):
+            return
+        self._standby = _Standby(self)
+
+    def _stop_standby(self):
+        standby, self._standby = self._standby, None
+        if standby:
+            standby.kill()
+
+    def _take_standby(self):
+        """Return the spare child if it's ready to take over (or None)"""
+        standby, self._standby = self._standby, None
+        if standby and not standby.alive:
+            standby.kill()
+            return None
+        return standby
+
+    def _switch_to_standby(self, standby):
+        """Make the spare child the child, already initialized: the language
+        metadata and the database are known from the previous one, so only the
+        environment is set up (after the unanswered requests are queued to be
+        replayed, which only go once it's ready)."""
+        self.log.info("Switching to the standby OOP CodeIntel process")
+        self.stats['failovers'] += 1
+        self._reset_protocol_state()
+        self.proc = standby.proc
+        self.pipe = standby.pipe
+        self._standby_reader = standby.reader
+        self._watchdog_thread = threading.Thread(
+            target=self._run_watchdog_thread,
+            name="CodeIntel Subprocess Watchdog Thread",
+            args=(self.proc,),
+        )
+        self._watchdog_thread.start()
+        self.state = CodeIntelManager.STATE_CONNECTED
+        if standby.handshake is not None:
+            self._negotiate(standby.handshake)
+        self._replay_requests()  # (before sending anything, only what the previous child didn't answer)
+        self._send_batch([
+            self._global_environment_request(self.env, self.prefs),
+            dict(command="set-xml-catalogs"),
+        ])
+        self.state = CodeIntelManager.STATE_READY
+        self._progress_callback(self, "CodeIntel ready.", CodeIntelManager.STATE_READY)
+        self._start_standby()
+
+    def _child_connection(self):
+        """Create the connection to the child, as per the oop mode"""
+        _oop_mode = self._oop_mode
+        if _oop_mode == 'pipe':
+            return _PipeConnection()
+        elif _oop_mode == 'tcp':
+            return _TCPConnection()
+        elif _oop_mode == 'server':
+            return _ServerConnection()
+        elif _oop_mode == 'unix' and _UnixConnection:
+            return _UnixConnection()
+        self.log.warn("Unknown codeintel oop mode %s, falling back to pipes", _oop_mode)
+        return _PipeConnection()
+
+    def _check_oop_mode(self):
+        """The child didn't connect; in unix oop mode, if it exited that's
+        most likely a codeintel without --unix, use pipes from now on"""
+        if self._oop_mode == 'unix' and self.proc not in (None, True) and _process_exited(self.proc):
+            self.log.warn("OOP CodeIntel exited on startup in unix oop mode (needs a codeintel supporting --unix), falling back to pipes")
+            self._oop_mode = 'pipe'
+
+    def _child_command(self, conn):
+        """Return the command line to run the child"""
+        codeintel_command = self.find_command()
+        cmd = [codeintel_command]
+
+        database_dir = os.path.expanduser('~/.codeintel')
+        cmd += ['--log-file', os.path.join(database_dir, 'codeintel.log')]
+        for log_level in self._log_levels:
+            cmd += ['--log-level', log_level]
+
+        cmd += ['oop']
+
+        cmd += ['--database-dir', database_dir]
+        cmd += conn.get_commandline_args()
+        if self._low_priority:
+            cmd = _low_priority_command() + cmd
+        return cmd
 
     def _run_watchdog_thread(self, proc):
         self.log.debug("Watchdog witing for OOP codeintel process to die...")
@@ -656,8 +1902,31 @@ class CodeIntelManager(threading.Thread):
         elif hasattr(proc, 'join'):
             proc.join()
         self.log.info("Child OOP CodeIntel process died!")
-        self.state = CodeIntelManager.STATE_WAITING
-        self.close()
+        if self.proc is proc and self.state not in (CodeIntelManager.STATE_QUITTING, CodeIntelManager.STATE_DESTROYED):
+            self.state = CodeIntelManager.STATE_WAITING
+            self.close()
+
+    def _schedule_init_requests(self):
+        """Send the initial requests once the handshake of the child has been
+        negotiated (so they can use the protocol extensions); without any
+        extensions enabled they go right away, and children which don't send
+        a handshake get them after a while."""
+        if not self._capabilities:
+            self._send_init_requests()
+            return
+        token = self._init_token = object()
+        self._call_later(self._handshake_timeout, functools.partial(self._init_requests_due, token))
+
+    def _init_requests_due(self, token):
+        with self._init_lock:
+            if token is None or self._init_token is not token:
+                return  # already sent (or the connection is gone)
+            self._init_token = None
+        self._send_init_requests()
+
+    def _call_later(self, delay, fn):
+        """Call fn (in a background thread) after delay seconds"""
+        self._timers.schedule(delay, fn)
 
     def _send_init_requests(self):
         assert threading.current_thread().name != "MainThread", \
@@ -665,6 +1934,7 @@ class CodeIntelManager(threading.Thread):
         self.log.debug("sending internal initial requests")
 
         outstanding_cpln_langs = set()
+        cpln_languages = {}
 
         def update(message=None, state=None, response=None):
             if state in (CodeIntelManager.STATE_DESTROYED, CodeIntelManager.STATE_BROKEN):
@@ -704,22 +1974,29 @@ class CodeIntelManager(threading.Thread):
                 update("Failed to get completion languages:", state=CodeIntelManager.STATE_DESTROYED, response=response)
                 return
             self.cpln_langs = sorted(response.get('languages'))
-            self.languages.clear()
-            for lang in self.cpln_langs:
-                outstanding_cpln_langs.add(lang)
-                self._send(callback=get_lang_info, command='get-language-info', language=lang)
+            cpln_languages.clear()
+            outstanding_cpln_langs.update(self.cpln_langs)
+            self._send_batch([
+                dict(callback=get_lang_info, command='get-language-info', language=lang)
+                for lang in self.cpln_langs
+            ])
 
         def get_lang_info(request, response):
             lang = request['language']
             if not response.get('success', False):
                 update("Failed to get information for %s:" % (lang,), state=CodeIntelManager.STATE_DESTROYED, response=response)
                 return
-            self.languages[lang] = dict(
+            cpln_languages[lang] = dict(
                 cpln_fillup_chars=response['completion-fillup-chars'],
                 cpln_stop_chars=response['completion-stop-chars'],
             )
             outstanding_cpln_langs.discard(lang)
             if not outstanding_cpln_langs:
+                # swap the languages all at once (buffers keep working meanwhile)
+                for language in list(self.languages):
+                    if language not in cpln_languages:
+                        del self.languages[language]
+                self.languages.update(cpln_languages)
                 fixup_db({}, {'success': True})
 
         def fixup_db(request, response):
@@ -793,55 +2070,196 @@ class CodeIntelManager(threading.Thread):
 
         def initialization_completed():
             self.log.debug("internal initial requests completed")
-            if not self._send_request_thread:
-                self._send_request_thread = threading.Thread(
-                    target=self._send_queued_requests,
-                    name="CodeIntel Manager Request Sending Thread")
-                self._send_request_thread.daemon = True
-                self._send_request_thread.start()
+            self._start_sending()
             update("CodeIntel ready.", state=CodeIntelManager.STATE_READY)
+            self._start_standby()
 
-        self._send(callback=get_citadel_langs, command='get-languages', type='citadel')
-        self._send(callback=get_xml_langs, command='get-languages', type='xml')
-        self._send(callback=get_stdlib_langs, command='get-languages', type='stdlib-supported')
-        self._send(callback=get_cpln_langs, command='get-languages', type='cpln')
-
-        self.set_global_environment(self.env, self.prefs)
+        self._send_batch([
+            dict(callback=get_citadel_langs, command='get-languages', type='citadel'),
+            dict(callback=get_xml_langs, command='get-languages', type='xml'),
+            dict(callback=get_stdlib_langs, command='get-languages', type='stdlib-supported'),
+            dict(callback=get_cpln_langs, command='get-languages', type='cpln'),
+        ])
 
         def update_callback(response):
             if not response.get("success", False):
                 update("Failed to get available catalogs:", state=CodeIntelManager.STATE_DESTROYED, response=response)
-        self.update_catalogs(update_callback=update_callback)
+                return
+            self._save_metadata()  # all initial requests answered
 
-        self.send(command="set-xml-catalogs")
+        self.send_batch([
+            self._global_environment_request(self.env, self.prefs),
+            self._update_catalogs_request(update_callback),
+            dict(command="set-xml-catalogs"),
+        ])
 
-    def set_global_environment(self, env, prefs):
+    def _global_environment_request(self, env, prefs):
         self.env = env
         self.prefs = [prefs] if isinstance(prefs, dict) else prefs
-        self.send(
+        return dict(
             command='set-environment',
             env=self.env,
-            prefs=self.prefs,
+            prefs=_without_project_scans(self.prefs) if self._leaves_project_scans else self.prefs,
         )
 
-    def update_catalogs(self, update_callback=None):
+    @property
+    def _leaves_project_scans(self):
+        """Whether the project and the extra paths are scanned by the scan
+        worker only (the child of this manager being an interactive one)"""
+        return self.service._scan_worker_enabled and not self._low_priority
+
+    def set_global_environment(self, env, prefs):
+        self.send(**self._global_environment_request(env, prefs))
+
+    def _update_catalogs_request(self, update_callback=None):
         def get_available_catalogs(request, response):
             if response.get("success", False):
                 self.available_catalogs = response.get('catalogs', [])
             if update_callback:
                 update_callback(response)
-        self.send(callback=get_available_catalogs, command='get-available-catalogs')
+        return dict(callback=get_available_catalogs, command='get-available-catalogs')
+
+    def update_catalogs(self, update_callback=None):
+        self.send(**self._update_catalogs_request(update_callback))
 
     def send(self, callback=None, **kwargs):
         """Public API for sending a request.
         Requests are expected to be well-formed (has a command, etc.)
         The callback recieves two arguments, the request and the response,
         both as dicts.
-        @note The callback is invoked on a background thread; proxy it to
-        the main thread if desired."""
+        @note The callback is invoked on a background thread (a response
+        worker), so it can do heavy work; proxy to the main thread only what
+        needs the UI."""
+        if self.state is CodeIntelManager.STATE_DESTROYED:
+            raise RuntimeError("Manager already shut down")
+        key = self._supersession_key(kwargs)
+        if key is not None:
+            self._supersede(key, kwargs)
+        if kwargs.get('command') == 'scan-document' and kwargs.get('path'):
+            callback, kwargs = self._coalesce_scan(callback, kwargs)
+        self._queue_request(callback, kwargs)
+
+    def send_batch(self, requests):
+        """Public API for sending several requests at once.
+        Each request is a dict of the arguments for send() (callback
+        included); with the batch capability they all travel in a single
+        frame (and are sent at the highest priority among them), otherwise
+        they're sent one by one. Responses come back separately, to the
+        callback of each request."""
+        if not self.has_capability('batch'):
+            for request in requests:
+                self.send(**request)
+            return
         if self.state is CodeIntelManager.STATE_DESTROYED:
             raise RuntimeError("Manager already shut down")
-        self.unsent_requests.put((callback, kwargs))
+        batch = []
+        for kwargs in requests:
+            kwargs = dict(kwargs)
+            callback = kwargs.pop('callback', None)
+            key = self._supersession_key(kwargs)
+            if key is not None:
+                self._supersede(key, kwargs)
+            if kwargs.get('command') == 'scan-document' and kwargs.get('path'):
+                callback, kwargs = self._coalesce_scan(callback, kwargs)
+            batch.append((callback, kwargs))
+        if batch:
+            self._queue_request(None, {
+                'command': 'batch',
+                'requests': batch,
+                'priority': min(kwargs.get('priority', PRIORITY_CURRENT) for callback, kwargs in batch),
+            })
+
+    def _coalesce_scan(self, callback, kwargs, newer=True):
+        """
+        Collapse a scan with the one still queued for the same path (if any)
+        into a single scan of the newest text, at the highest priority of
+        both (so an immediate scan promotes a background one) and calling
+        both callbacks. The queued scan is then dropped when it comes out of
+        the queue. Returns the (callback, request data) to queue.
+        """
+        path = kwargs['path']
+        with self._scans_lock:
+            pending = self._pending_scans.get(path)
+            if pending:
+                pending_callback, pending_kwargs = pending
+                priority = min(kwargs.get('priority', PRIORITY_CURRENT), pending_kwargs.get('priority', PRIORITY_CURRENT))
+                if newer:
+                    callback = _chain_callbacks(pending_callback, callback)
+                    kwargs = dict(kwargs, priority=priority)
+                else:
+                    callback = _chain_callbacks(callback, pending_callback)
+                    kwargs = dict(pending_kwargs, priority=priority)
+                self.stats['coalesced_scans'] += 1
+                self.log.debug("Coalesced queued scans of %s", path)
+            self._pending_scans[path] = (callback, kwargs)
+        return callback, kwargs
+
+    def _supersession_key(self, request):
+        """Return the key (view, command and kind) of the requests which
+        supersede each other, or None if the request can't be superseded;
+        only requests of the same kind do (a calltip lookup doesn't drop a
+        completion one, nor a preceding trigger lookup a trigger one)"""
+        vid = request.get('vid')
+        command = request.get('command')
+        if vid is None or command not in self._superseding_commands:
+            return None
+        if command == 'eval':
+            kind = (request.get('trg') or {}).get('form')
+        else:
+            kind = request.get('type')
+            if 'curr-pos' in request:
+                kind = (kind, 'preceding')
+        return vid, command, kind
+
+    def _supersede(self, key, kwargs):
+        """A newer request arrived; the older ones with the same key still
+        queued are dropped (when taken out of the queue) and the one already
+        sent gets aborted. The callbacks of superseded requests are never
+        called (so handlers' done() isn't either): handlers must not depend
+        on it for cleanup, the newer request's callback gets the results."""
+        with self._supersession_lock:
+            self._latest_requests[key] = kwargs
+            req_id = self._running_requests.pop(key, None)
+        if req_id is not None and req_id in self.requests:
+            self.log.debug("Aborting superseded request %s (command %s)", req_id, key[1])
+            self._superseded.add(req_id)
+            self._request_payloads.pop(req_id, None)  # (it's never resent, don't hold on to its text)
+            self.stats['superseded_running'] += 1
+            self.send(
+                command='abort',
+                id=req_id,
+                priority=PRIORITY_IMMEDIATE,
+                callback=lambda request, response: None,
+            )
+
+    def _queue_request(self, callback, kwargs):
+        """Queue a request for the sender, by the priority it's tagged with
+        ((None, None) stops the sender)"""
+        if callback is None and kwargs is None:
+            self.unsent_requests.put((callback, kwargs), PRIORITY_CONTROL)
+            return
+        self.unsent_requests.put((callback, kwargs), kwargs.get('priority', PRIORITY_CURRENT), self._request_class(kwargs))
+
+    def _request_class(self, request):
+        """Return the class of the request (for the in-flight windows)"""
+        command = request.get('command')
+        if command == 'abort':
+            return None  # no window, aborts free the others
+        if command == 'batch':
+            classes = set(self._request_class(kwargs) for callback, kwargs in request['requests'])
+            return 'interactive' if 'interactive' in classes else classes.pop()
+        if command in self._bulk_commands:
+            return 'bulk'
+        return 'interactive'
+
+    def _start_sending(self):
+        """Start sending the queued requests"""
+        if not self._send_request_thread:
+            self._send_request_thread = threading.Thread(
+                target=self._send_queued_requests,
+                name="CodeIntel Manager Request Sending Thread")
+            self._send_request_thread.daemon = True
+            self._send_request_thread.start()
 
     def _send_queued_requests(self):
         """Worker to send unsent requests"""
@@ -849,15 +2267,45 @@ class CodeIntelManager(threading.Thread):
         self.log.info("%s thread started..." % threading.current_thread().name)
 
         while self.state not in (CodeIntelManager.STATE_QUITTING, CodeIntelManager.STATE_DESTROYED):
-            if self.state is not CodeIntelManager.STATE_READY:
-                with self._state_condvar:
+            with self._state_condvar:
+                if self.state is not CodeIntelManager.STATE_READY:
                     self._state_condvar.wait()
                     continue  # wait...
             callback, kwargs = self.unsent_requests.get()
             if callback is None and kwargs is None:
                 # end of queue (shutting down)
                 break
-            self._send(callback, **kwargs)
+            if self.state in (CodeIntelManager.STATE_WAITING, CodeIntelManager.STATE_CONNECTED):
+                # the child died while waiting, keep it for the next one
+                self._queue_request(callback, kwargs)
+                continue
+            # Coalesce whatever else gets queued (within the batch limits)
+            # into a single write
+            frames = []
+            size = 0
+            deadline = time.time() + self._batch_max_latency
+            while True:
+                frame = self._prepare_frame(callback, kwargs)
+                if frame:
+                    frames.append(frame)
+                    size += len(frame[0]) + len(frame[1])
+                if size >= self._batch_max_bytes or len(frames) >= self._batch_max_frames:
+                    break
+                try:
+                    timeout = deadline - time.time()
+                    if timeout > 0:
+                        callback, kwargs = self.unsent_requests.get(True, timeout)
+                    else:
+                        callback, kwargs = self.unsent_requests.get(False)
+                except queue.Empty:
+                    break
+                if callback is None and kwargs is None:
+                    break
+            if frames:
+                self._write_frames(frames)
+            if callback is None and kwargs is None:
+                # end of queue (shutting down)
+                break
 
         self.log.info("%s thread ended!" % threading.current_thread().name)
 
@@ -869,29 +2317,323 @@ class CodeIntelManager(threading.Thread):
         calling thread until the data has been written (though possibly not yet
         received on the other end).
         """
+        frame = self._prepare_frame(callback, kwargs)
+        if frame:
+            self._write_frames([frame])
+
+    def _send_batch(self, requests):
+        """
+        Private API for sending several requests (dicts of the arguments for
+        _send()) at once, in a single frame if the child supports batches.
+        """
+        if not self.has_capability('batch'):
+            for request in requests:
+                self._send(**request)
+            return
+        batch = []
+        for kwargs in requests:
+            kwargs = dict(kwargs)
+            batch.append((kwargs.pop('callback', None), kwargs))
+        self._send(command='batch', requests=batch)
+
+    def _prepare_frame(self, callback, kwargs):
+        """Register the request (or the requests in a batch) and return its
+        frame (as a tuple of the length and data buffers)"""
         if not self.pipe:
             return
-        req_id = hex(self._next_id)
-        kwargs['req_id'] = req_id
-        text = json.dumps(kwargs, separators=(',', ':'))
-        # Keep the request parameters so the handler can examine it; however,
-        # drop the text and env, because those are huge and usually useless
-        kwargs.pop('text', None)
-        kwargs.pop('env', None)
-        self.requests[req_id] = (callback, kwargs, time.time())
-        self._next_id += 1
-        self.log.debug("sending frame: %s", text)
-        text = text.encode('utf-8')
-        length = "%i" % len(text)
+        if kwargs.get('command') == 'batch':
+            requests = [(callback, request) for callback, request in kwargs['requests'] if self._prepare_request(request)]
+            if not requests:
+                return
+            kwargs = {
+                'command': 'batch',
+                'requests': [request for callback, request in requests],
+            }
+        elif self._prepare_request(kwargs):
+            requests = [(callback, kwargs)]
+        else:
+            return
+        if self.has_capability('msgpack'):
+            self.log.debug("sending frame: %r", kwargs)
+            data = umsgpack.dumps(kwargs)
+        else:
+            data = json.dumps(kwargs, separators=(',', ':'))
+            self.log.debug("sending frame: %s", data)
+            data = data.encode('utf-8')
+        for callback, request in requests:
+            # Keep the request parameters so the handler can examine it; however,
+            # drop the text and env, because those are huge and usually useless
+            req_id = request['req_id']
+            payload = dict((k, request.pop(k)) for k in ('text', 'env') if k in request)
+            if payload:
+                self._request_payloads.setdefault(req_id, {}).update(payload)
+            self._register_request(req_id, callback, request)
+        if len(data) >= self._compression_threshold and self.has_capability('zlib'):
+            data = self._compress(data)
+        length = "%i" % len(data)
         length = length.encode('utf-8')
-        buf = length + text
+        return length, data
+
+    def _prepare_request(self, kwargs):
+        """Tag the request with its id and get its text ready to send;
+        returns False if the request is not to be sent after all"""
+        req_id = hex(next(self._ids))
+        key = self._supersession_key(kwargs)
+        if key is not None:
+            with self._supersession_lock:
+                if self._latest_requests.get(key) is not kwargs:
+                    self.log.debug("Dropping superseded request (command %s)", key[1])
+                    self.stats['superseded_queued'] += 1
+                    return False
+                self._running_requests[key] = req_id
+        if kwargs.get('command') == 'scan-document' and kwargs.get('path'):
+            with self._scans_lock:
+                pending = self._pending_scans.get(kwargs['path'])
+                if pending is None or pending[1] is not kwargs:
+                    self.log.debug("Dropping scan of %s, coalesced with a newer one", kwargs['path'])
+                    return False
+                del self._pending_scans[kwargs['path']]
+        kwargs['req_id'] = req_id
+        env = kwargs.get('env')
+        if isinstance(env, dict) and env.get('prefs') and self._leaves_project_scans:
+            kwargs['env'] = dict(env, prefs=_without_project_scans(env['prefs']))
+        if kwargs.get('text') is not None and kwargs.get('path'):
+            if self.has_capability('text-ref'):
+                self._dedup_text(req_id, kwargs)
+            if 'text' in kwargs and self.has_capability('incremental-sync'):
+                self._sync_text(req_id, kwargs)
+            if 'text' in kwargs and len(kwargs['text']) >= self._shared_memory_threshold and kwargs.get('vid') is not None and self.has_capability('shared-memory'):
+                self._share_text(req_id, kwargs)
+        return True
+
+    def _register_request(self, req_id, callback, request):
+        """Keep track of a request being sent, until it's completed or it
+        times out"""
+        self.requests[req_id] = (callback, request, time.time())
+        self.unsent_requests.started(self._request_class(request))
+        self._schedule_timeout(req_id, self._timeout_for(request))
+
+    def _timeout_for(self, request):
+        """Seconds without news after which the request times out"""
+        return self._request_timeouts.get(request.get('command'), self._request_timeout)
+
+    def _schedule_timeout(self, req_id, delay):
+        timer = self._timers.schedule(delay, functools.partial(self._timed_out, req_id))
+        self._timers.cancel(self._timeout_timers.get(req_id))
+        self._timeout_timers[req_id] = timer
+
+    def _timed_out(self, req_id):
+        callback, request, sent_time = self.requests.get(req_id, (None, None, None))
+        if request is None:
+            self._timeout_timers.pop(req_id, None)
+            return  # already completed
+        remaining = sent_time + self._timeout_for(request) - time.time()
+        if remaining > 0:
+            # got (unfinished) responses meanwhile
+            self._schedule_timeout(req_id, remaining)
+            return
+        self._response_workers.submit(req_id, functools.partial(self._expire_request, req_id, callback, request))
+
+    def _write_frames(self, frames):
+        """Write frames to the pipe, all at once"""
+        bufs = [buf for frame in frames for buf in frame]
         try:
-            self.pipe.write(buf)
+            with self._write_lock:
+                pipe = self.pipe
+                if not pipe:
+                    return
+                pipe.writev(bufs)
         except Exception as e:
             message = "Error writing data to OOP CodeIntel: %s" % e
             self.log.error(message)
             self._progress_callback(self, message)
             self.close()
+            return
+        size = sum(len(buf) for buf in bufs)
+        self.stats['writes'] += 1
+        self.stats['write_frames'] += len(frames)
+        self.stats['write_bytes'] += size
+        self.log.debug("Wrote %d frames (%d bytes)", len(frames), size)
+
+    def _dedup_text(self, req_id, kwargs):
+        """
+        Content-addressed text deduplication; texts are tagged with a
+        reference (their hash) and, if the text for a path didn't change since
+        it was last sent, only the reference is sent.
+        """
+        path = kwargs['path']
+        text = kwargs['text']
+        self._request_payloads[req_id] = {'text': text}
+        text_ref, sent_text = self._text_refs.get(path, (None, None))
+        if sent_text is not None and (text is sent_text or text == sent_text):
+            del kwargs['text']
+        else:
+            text_ref = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            self._text_refs[path] = (text_ref, text)
+        kwargs['text_ref'] = text_ref
+
+    def _share_text(self, req_id, kwargs):
+        """Put the text in shared memory, send only where to find it"""
+        text = kwargs['text']
+        data = text.encode('utf-8')
+        try:
+            name, offset = self._shared_texts.put(kwargs['vid'], req_id, data)
+        except Exception as e:
+            self.log.error("Error sharing text, sending it through the pipe: %s", e)
+            return
+        self._request_payloads.setdefault(req_id, {})['text'] = text
+        del kwargs['text']
+        kwargs['text_shm'] = {
+            'name': name,
+            'offset': offset,
+            'length': len(data),
+        }
+
+    def _forget_request(self, req_id):
+        """Drop a request and everything kept for it"""
+        callback, request, sent_time = self.requests.pop(req_id, (None, None, None))
+        if request is not None:
+            self.unsent_requests.finished(self._request_class(request))
+        self._request_payloads.pop(req_id, None)
+        self._timers.cancel(self._timeout_timers.pop(req_id, None))
+        self._shared_texts.release(req_id)
+        self._superseded.discard(req_id)
+        key = request and self._supersession_key(request)
+        if key is not None:
+            with self._supersession_lock:
+                if self._running_requests.get(key) == req_id:
+                    del self._running_requests[key]
+                if self._latest_requests.get(key) is request:
+                    del self._latest_requests[key]
+
+    def _record_latency(self, command, elapsed):
+        latency = self._latencies.get(command)
+        if latency is None:
+            self._latencies[command] = elapsed
+        else:
+            self._latencies[command] = latency + 0.2 * (elapsed - latency)
+
+    def gauges(self):
+        """Current number of requests queued and in flight, by request class"""
+        return self.unsent_requests.gauges()
+
+    def latency(self, command):
+        """Average round trip time (in seconds) of the requests of a command"""
+        return self._latencies.get(command, 0)
+
+    def forget_view(self, vid):
+        """The view is gone, drop what is kept for it"""
+        self._shared_texts.discard(vid)
+        with self._supersession_lock:
+            for key in [key for key in self._latest_requests if key[0] == vid]:
+                del self._latest_requests[key]
+            for key in [key for key in self._running_requests if key[0] == vid]:
+                del self._running_requests[key]
+
+    def forget_text(self, path):
+        """No view has the path open anymore, drop the copy of its text kept
+        to send only what changes (the next text for it is sent in full, with
+        a newer version)"""
+        synced = self._synced_texts.get(path)
+        if synced is not None:
+            self._synced_texts[path] = (synced[0], None)
+        self._text_refs.pop(path, None)
+
+    def _compress(self, data):
+        start = time.time()
+        compressed = zlib.compress(data, self._compression_level)
+        elapsed = time.time() - start
+        self.stats['compress_frames'] += 1
+        self.stats['compress_bytes_in'] += len(data)
+        self.stats['compress_bytes_out'] += len(compressed)
+        self.stats['compress_time'] += elapsed
+        self.log.debug("Compressed frame %d -> %d bytes (ratio %0.2f) in %0.2f ms", len(data), len(compressed), float(len(compressed)) / len(data), elapsed * 1000)
+        if len(compressed) < len(data):
+            return compressed
+        return data
+
+    def _decompress(self, data):
+        start = time.time()
+        decompressed = zlib.decompress(data)
+        elapsed = time.time() - start
+        self.stats['decompress_frames'] += 1
+        self.stats['decompress_bytes_in'] += len(data)
+        self.stats['decompress_bytes_out'] += len(decompressed)
+        self.stats['decompress_time'] += elapsed
+        self.log.debug("Decompressed frame %d -> %d bytes (ratio %0.2f) in %0.2f ms", len(data), len(decompressed), float(len(data)) / len(decompressed), elapsed * 1000)
+        return decompressed
+
+    def _sync_text(self, req_id, kwargs):
+        """
+        Incremental text synchronization; every text sent for a path gets a
+        new version and, once the child has the text for the path, only the
+        ranges edited since the previous version are sent.
+        """
+        path = kwargs['path']
+        text = kwargs['text']
+        version, synced_text = self._synced_texts.get(path, (0, None))
+        version += 1
+        self._synced_texts[path] = (version, text)
+        self._request_payloads[req_id] = {'text': text}
+        kwargs['text-version'] = version
+        if synced_text is not None:
+            del kwargs['text']
+            kwargs['base-version'] = version - 1
+            kwargs['text-changes'] = _text_changes(synced_text, text)
+
+    def _negotiate(self, handshake):
+        """Tell the child which of the protocol extensions announced in its
+        handshake frame are going to be used on this connection"""
+        self.server_capabilities = frozenset(handshake.get('capabilities', ()))
+        if not self.server_capabilities:
+            return
+        self.log.info("OOP CodeIntel capabilities: %s", ", ".join(sorted(self.server_capabilities)))
+        capabilities = sorted(c for c in self._capabilities if c in self.server_capabilities)
+        if capabilities:
+            self._send(
+                command='set-capabilities',
+                capabilities=capabilities,
+                compression_threshold=self._compression_threshold,
+            )
+
+    def _resend_full_text(self, req_id, callback, request):
+        """The child lost track of the text for a request; queue it again
+        carrying the full text"""
+        self._synced_texts.pop(request.get('path'), None)
+        self._text_refs.pop(request.get('path'), None)
+        self._resend_request(req_id, callback, request)
+
+    def _resend_request(self, req_id, callback, request, replays=0):
+        """Queue a request already sent to the child again (carrying its full
+        text), for the callback to get the response to the new one; replays
+        counts the times it was sent again because the child died"""
+        payload = self._request_payloads.get(req_id, {})
+        key = self._supersession_key(request)
+        if key is not None:
+            with self._supersession_lock:
+                superseded = self._latest_requests.get(key) is not request
+        else:
+            superseded = False
+        self._forget_request(req_id)
+        if superseded:
+            return  # a newer request is on its way, don't bother
+        if payload.get('text') is None and any(name in request for name in ('text_ref', 'text_shm', 'text-changes')):
+            self.log.error("Can't resend request %s (command %s), text is gone", req_id, request.get('command'))
+            if callback:
+                callback(request, {'success': False, 'message': "Text out of sync"})
+            return
+        self.log.debug("Resending request %s (command %s)", req_id, request.get('command'))
+        request = dict(request, **payload)
+        if replays:
+            request['replays'] = replays
+        for name in ('req_id', 'text_ref', 'text_shm', 'text-version', 'base-version', 'text-changes'):
+            request.pop(name, None)
+        if key is not None:
+            with self._supersession_lock:
+                self._latest_requests.setdefault(key, request)
+        if request.get('command') == 'scan-document' and request.get('path'):
+            callback, request = self._coalesce_scan(callback, request, newer=False)
+        self._queue_request(callback, request)
 
     def run(self):
         """Event loop for the codeintel manager background thread"""
@@ -900,6 +2642,8 @@ class CodeIntelManager(threading.Thread):
 
         self.log.info("%s thread started..." % threading.current_thread().name)
 
+        self._warm_start()
+
         while self.state not in (CodeIntelManager.STATE_QUITTING, CodeIntelManager.STATE_DESTROYED):
             ok = False
 
@@ -907,39 +2651,17 @@ class CodeIntelManager(threading.Thread):
             if not self.proc:
                 break  # init child failed
 
-            first_buf = True
+            reader, self._standby_reader = self._standby_reader, None
+            first_buf = reader is None or not self.server_capabilities  # (unless the standby's handshake was read already)
             try:
-                buf = b''
+                if reader is None:
+                    reader = _FrameReader(self.pipe)
                 while self.proc and self.pipe:
-                    # Loop to read from the pipe
-                    ch = self.pipe.read(1)
-                    if not ch:
-                        # nothing read, EOF
-                        raise IOError("Failed to read from socket")
+                    # Loop to read frames from the pipe
+                    frame = reader.read_frame()
                     ok = True
-                    if ch == b'{':
-                        length = int(buf)
-                        buf = ch
-                        while len(buf) < length:
-                            data = self.pipe.read(length - len(buf))
-                            if not data:
-                                # nothing read, EOF
-                                raise IOError("Failed to read from socket")
-                            buf += data
-                        self.log.debug("Got codeintel response: %r" % buf)
-                        if first_buf and buf == b'{}':
-                            first_buf = False
-                            buf = b''
-                            continue
-                        response = json.loads(buf.decode('utf-8'))
-                        self.handle(response)  # handle runs asynchronously and shouldn't raise exceptions
-                        buf = b''
-                    elif ch in b'0123456789':
-                        buf += ch
-                    elif ch in b' \t\r\n':
-                        pass
-                    else:
-                        raise ValueError("Invalid frame length character: %r" % ch)
+                    self._receive(frame, first_buf)
+                    first_buf = False
 
             except Exception as e:
                 if self.state in (CodeIntelManager.STATE_QUITTING, CodeIntelManager.STATE_DESTROYED):
@@ -951,31 +2673,50 @@ class CodeIntelManager(threading.Thread):
                 self.state = CodeIntelManager.STATE_WAITING
                 self.close()
 
-            if not ok:
+            if not ok and not (self._standby and self._standby.alive):
                 time.sleep(3)
 
         self.log.info("%s thread ended!" % threading.current_thread().name)
 
+    def _receive(self, frame, first_frame=False):
+        """Decode a frame read from the child and handle it; the first frame
+        can be the initial handshake"""
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Got codeintel response: %r", frame.tobytes())
+        if frame[0:1] == b'x':
+            frame = self._decompress(frame)
+        response = _decode_frame(frame)
+        if first_frame and 'req_id' not in response and 'command' not in response:
+            # initial handshake frame (maybe announcing protocol extensions)
+            self._negotiate(response)
+            self._init_requests_due(self._init_token)
+            return
+        self.handle(response)  # handle runs asynchronously and shouldn't raise exceptions
+
+    def _expire_request(self, req_id, callback, request, message=None):
+        """Give up on a request (its callback gets a timeout response)"""
+        if req_id not in self.requests:
+            return  # completed just now
+        try:
+            if callback and req_id not in self._superseded:
+                callback(request, {
+                    'req_id': req_id,
+                    'command': request.get('command'),
+                    'success': False,
+                    'timeout': True,
+                    'message': "%s (command %s)" % (message or "Request timed out", request.get('command')),
+                })
+        except Exception as e:
+            self.log.error("Failed timing out request")
+        else:
+            self.log.debug("Discarding request %r", request)
+        self._forget_request(req_id)
+
     def handle(self, response):
         """Handle a response from the codeintel process"""
         def _handle():
-            assert threading.current_thread().name == "MainThread", \
-                "CodeIntelManager.handle() should run on main thread!"
-
-            now = time.time()
-            if now - self._discard_time > 60:  # (not so often) discard some stale results
-                self._discard_time = now
-                for req_id, (callback, request, sent_time) in list(self.requests.items()):
-                    if sent_time < now - 5 * 60:
-                        # sent 5 minutes ago - it's irrelevant now
-                        try:
-                            if callback:
-                                callback(request, {})
-                        except Exception as e:
-                            self.log.error("Failed timing out request")
-                        else:
-                            self.log.debug("Discarding request %r", request)
-                        del self.requests[req_id]
+            assert threading.current_thread().name != "MainThread", \
+                "CodeIntelManager.handle() should run on background thread!"
 
             self.log.debug("handling: %r", response)
             req_id = response.get('req_id')
@@ -1001,22 +2742,35 @@ class CodeIntelManager(threading.Thread):
                         req_id, response_command or '%r' % response, sorted(self.requests.keys()))
                 return
             self.log.debug("Request %s (command %s) took %0.2f seconds", req_id, request_command or '<unknown>', time.time() - sent_time)
+            if req_id in self._superseded:
+                # aborted, nobody is going to see the results (nor is the
+                # callback called, see _supersede)
+                if 'success' in response:
+                    self._forget_request(req_id)
+                return
+            if response.get('version-mismatch') or response.get('unknown-text-ref'):
+                # child's text for the path is not the one the changes are based
+                # on, or it doesn't know (anymore) the text referenced
+                self._resend_full_text(req_id, callback, request)
+                return
             if 'success' in response:
                 # remove completed request
                 self.log.debug("Removing completed request %s", req_id)
-                del self.requests[req_id]
+                self._forget_request(req_id)
+                self._record_latency(request_command, time.time() - sent_time)
             else:
                 # unfinished response; update the sent time so it doesn't time out
                 self.requests[req_id] = (callback, request, time.time())
             if callback:
                 callback(request, response)
-        self.service._main_thread_runner(_handle)  # Do handling in main thread
+        self._response_workers.submit(response.get('req_id'), _handle)  # Do handling in a background worker
 
     def do_scan_complete(self, response):
         """Scan complete unsolicited response"""
         path = response.get('path')
         if path:
             buf = self.service.buf_from_path(path)
+            self.service.completion_cache.invalidate(path)
             self.service.notify_observers('codeintel_buffer_scanned', buf)
 
     def do_report_message(self, response):
@@ -1038,13 +2792,53 @@ class CodeIntelManager(threading.Thread):
 
     def do_quit(self, request, response):
         """Quit successful"""
-        assert threading.current_thread().name == "MainThread", \
-            "CodeIntelManager.activate::do_quit() should run on main thread!"
+        assert threading.current_thread().name != "MainThread", \
+            "CodeIntelManager.activate::do_quit() should run on background thread!"
         self.kill()
         if self.is_alive():
             self.join(1)
 
 
+def _without_project_scans(prefs):
+    """Return a copy of the prefs (list of dicts) with the scans of the
+    project and of the extra paths turned off"""
+    return [
+        dict(((k, v) for k, v in pref.items() if not k.endswith('ExtraPaths')), codeintel_scan_files_in_project=False)
+        for pref in prefs or []
+    ]
+
+
+def _low_priority_command():
+    """Return the command line prefix to run a process at low CPU (nice) and
+    IO (ionice, Linux only) priority, as far as the tools are available"""
+    cmd = []
+    nice = find_executable('nice')
+    if nice:
+        cmd += [nice, '-n', '10']
+    if sys.platform.startswith('linux'):
+        ionice = find_executable('ionice')
+        if ionice:
+            cmd += [ionice, '-c', '2', '-n', '7']  # lowest best-effort priority
+    return cmd
+
+
+def get_manager_class(engine=None):
+    """Return the CodeIntelManager class implementing the engine:
+    threads - A thread for reading, another for sending and a watchdog.
+    asyncio - Everything on an asyncio event loop in a single thread (needs
+        Python 3.5 or above and isn't available on Windows)."""
+    if engine == 'asyncio':
+        try:
+            from .codeintel_asyncio import AsyncioCodeIntelManager
+        except (ImportError, SyntaxError) as e:
+            logger.warn("CodeIntel asyncio engine not available (%s), falling back to threads", e)
+        else:
+            return AsyncioCodeIntelManager
+    elif engine not in (None, 'threads'):
+        logger.warn("Unknown codeintel engine %s, falling back to threads", engine)
+    return CodeIntelManager
+
+
 class CodeIntelBuffer(object):
     """A buffer-like object for codeintel; this is specific to a
     CodeIntelManager instance."""
@@ -1056,12 +2850,14 @@ class CodeIntelBuffer(object):
         self.lang = lang
         self.path = path
         self.text = text
+        self.mgr = None  # manager of its language's shard, if any (see CodeIntel._bind_buffers)
         self._env = env
         self._prefs = [prefs] if isinstance(prefs, dict) else prefs
 
     @property
     def env(self):
-        env = dict(self.service.mgr and self.service.mgr.env or {})
+        mgr = self.mgr or self.service.mgr
+        env = dict(mgr and mgr.env or {})
         env.update(self._env or {})
         return env
 
@@ -1071,7 +2867,8 @@ class CodeIntelBuffer(object):
 
     @property
     def prefs(self):
-        prefs = list(self.service.mgr and self.service.mgr.prefs or [])
+        mgr = self.mgr or self.service.mgr
+        prefs = list(mgr and mgr.prefs or [])
         for pref in self._prefs or []:
             if pref not in prefs:
                 prefs.append(pref)
@@ -1096,7 +2893,7 @@ class CodeIntelBuffer(object):
     def cpln_stop_chars(self):
         return self.service.languages[self.lang]['cpln_stop_chars']
 
-    def scan_document(self, handler, lines_added, file_mtime=False, callback=None):
+    def scan_document(self, handler, lines_added, file_mtime=False, callback=None, priority=None):
         def invoke_callback(request, response):
             if not response.get('success'):
                 msg = response.get('message')
@@ -1107,6 +2904,8 @@ class CodeIntelBuffer(object):
                 except Exception as e:
                     self.log.error("Error reporting scan_document error: %s", response.get('message', e))
                     pass
+                if callback is not None:
+                    callback(request, response)
                 return
             try:
                 handler.on_document_scanned(self)
@@ -1121,6 +2920,7 @@ class CodeIntelBuffer(object):
         self.service.send(
             command='scan-document',
             path=self.path,
+            vid=self.vid,
             language=self.lang,
             env={
                 'env': self.env,
@@ -1129,13 +2929,13 @@ class CodeIntelBuffer(object):
             text=self.text,
             encoding='utf-8',
             discardable=True,
-            priority=PRIORITY_IMMEDIATE if lines_added else PRIORITY_CURRENT,
+            priority=priority or (PRIORITY_IMMEDIATE if lines_added else PRIORITY_CURRENT),
             mtime=mtime,
             callback=invoke_callback,
         )
 
-    def _post_trg_from_pos_handler(self, handler, context, request, response):
-        # This needs to be proxied to the main thread for the callback invocation
+    def _post_trg_from_pos_handler(self, handler, context, request, response, snapshot=None):
+        # This runs in a response worker; handlers proxy UI work to the main thread
         if not response.get('success'):
             msg = response.get('message')
             if not msg:
@@ -1149,16 +2949,20 @@ class CodeIntelBuffer(object):
         else:
             trg = response['trg']
         try:
-            if trg:
+            if trg and snapshot is not None:
+                # completions to cache, evaluate them knowing the text
+                self.async_eval_at_trg(handler, trg, snapshot=snapshot)
+            elif trg:
                 handler.on_trg_from_pos(self, context, trg)
         except Exception as e:
             self.log.error("Error calling %s callback: %s", context, e)
             pass
 
-    def trg_from_pos(self, handler, implicit, pos=None):
+    def trg_from_pos(self, handler, implicit, pos=None, snapshot=None):
         self.service.send(
             command='trg-from-pos',
             path=self.path,
+            vid=self.vid,
             language=self.lang,
             pos=self.pos if pos is None else pos,
             env={
@@ -1168,13 +2972,67 @@ class CodeIntelBuffer(object):
             implicit=implicit,
             text=self.text,
             encoding='utf-8',
-            callback=functools.partial(self._post_trg_from_pos_handler, handler, 'trg_from_pos')
+            priority=PRIORITY_IMMEDIATE,
+            callback=functools.partial(self._post_trg_from_pos_handler, handler, 'trg_from_pos', snapshot=snapshot)
+        )
+
+    def _post_complete_at_pos_handler(self, handler, request, response, snapshot=None):
+        # This runs in a response worker; handlers proxy UI work to the main thread
+        trg = response.get('trg')
+        if response.get('success') and not trg:
+            handler.done()  # no trigger at the position, nothing was evaluated
+            return
+        self._post_eval_handler(handler, trg, request, response, snapshot=snapshot)
+
+    def complete_at_pos(self, handler, implicit, pos=None):
+        """Get the trigger at the position and evaluate it (in a single round
+        trip if the child supports it, otherwise trg_from_pos followed by the
+        handler's on_trg_from_pos); completions of a trigger the name being
+        typed at the cursor follows come from the completion cache, as do
+        completions for the ones asked for (see _CompletionCache)"""
+        text = self.text
+        snapshot = None
+        change_count = getattr(self, 'change_count', None)
+        if pos is None and change_count is not None:
+            snapshot = (text, change_count, self.original_pos)
+            cached = self.service.completion_cache.lookup(self.lang, self.path, *snapshot)
+        else:
+            cached = None
+        if cached is not None:
+            cplns, trg = cached
+            try:
+                handler.set_auto_complete_info(self, cplns, trg)
+            except Exception as e:
+                self.log.error("Error calling set_auto_complete_info: %s", e)
+            finally:
+                handler.done()
+            return
+        mgr = self.service.mgr_for(self.lang)
+        if not mgr or not mgr.has_capability('complete-at-pos'):
+            self.trg_from_pos(handler, implicit, pos, snapshot=snapshot)
+            return
+        self.service.send(
+            command='complete-at-pos',
+            path=self.path,
+            vid=self.vid,
+            language=self.lang,
+            pos=self.pos if pos is None else pos,
+            env={
+                'env': self.env,
+                'prefs': self.prefs,
+            },
+            implicit=implicit,
+            text=text,
+            encoding='utf-8',
+            priority=PRIORITY_IMMEDIATE,
+            callback=functools.partial(self._post_complete_at_pos_handler, handler, snapshot=snapshot)
         )
 
     def preceding_trg_from_pos(self, handler, curr_pos, pos=None):
         self.service.send(
             command='trg-from-pos',
             path=self.path,
+            vid=self.vid,
             language=self.lang,
             pos=self.pos if pos is None else pos,
             env={
@@ -1183,6 +3041,7 @@ class CodeIntelBuffer(object):
             },
             text=self.text,
             encoding='utf-8',
+            priority=PRIORITY_IMMEDIATE,
             callback=functools.partial(self._post_trg_from_pos_handler, handler, 'preceding_trg_from_pos'),
             **{'curr-pos': curr_pos}
         )
@@ -1192,6 +3051,7 @@ class CodeIntelBuffer(object):
             command='trg-from-pos',
             type='defn',
             path=self.path,
+            vid=self.vid,
             language=self.lang,
             pos=self.pos if pos is None else pos,
             env={
@@ -1200,48 +3060,54 @@ class CodeIntelBuffer(object):
             },
             text=self.text,
             encoding='utf-8',
+            priority=PRIORITY_IMMEDIATE,
             callback=functools.partial(self._post_trg_from_pos_handler, handler, 'defn_trg_from_pos')
         )
 
-    def async_eval_at_trg(self, handler, trg, silent=False, keep_existing=False):
-        def callback(request, response):
-            try:
-                if not response.get('success'):
-                    try:
-                        handler.set_status_message(self, response.get('message', ""), response.get('highlight', False))
-                    except Exception as e:
-                        self.log.error("Error reporting async_eval_at_trg error: %s", response.get("message", e))
-                        pass
-                    return
+    def _post_eval_handler(self, handler, trg, request, response, snapshot=None):
+        # This runs in a response worker; handlers proxy UI work to the main thread
+        try:
+            if not response.get('success'):
+                try:
+                    handler.set_status_message(self, response.get('message', ""), response.get('highlight', False))
+                except Exception as e:
+                    self.log.error("Error reporting async_eval_at_trg error: %s", response.get("message", e))
+                    pass
+                return
 
-                if 'retrigger' in response:
-                    trg['retriggerOnCompletion'] = response['retrigger']
-
-                if 'cplns' in response:
-                    # split into separate lists
-                    cplns = response['cplns']
-                    try:
-                        handler.set_auto_complete_info(self, cplns, trg)
-                    except Exception as e:
-                        self.log.error("Error calling set_auto_complete_info: %s", e)
-                        pass
-                elif 'calltip' in response:
-                    try:
-                        handler.set_call_tip_info(self, response['calltip'], request.get('explicit', False), trg)
-                    except Exception as e:
-                        self.log.error("Error calling set_call_tip_info: e", e)
-                        pass
-                elif 'defns' in response:
-                    handler.set_definitions_info(self, response['defns'], trg)
-            finally:
-                handler.done()
+            if 'retrigger' in response:
+                trg['retriggerOnCompletion'] = response['retrigger']
 
+            if 'cplns' in response:
+                # split into separate lists
+                cplns = response['cplns']
+                if snapshot is not None:
+                    self.service.completion_cache.store(self.lang, self.path, snapshot, trg, cplns)
+                try:
+                    handler.set_auto_complete_info(self, cplns, trg)
+                except Exception as e:
+                    self.log.error("Error calling set_auto_complete_info: %s", e)
+                    pass
+            elif 'calltip' in response:
+                try:
+                    handler.set_call_tip_info(self, response['calltip'], request.get('explicit', False), trg)
+                except Exception as e:
+                    self.log.error("Error calling set_call_tip_info: e", e)
+                    pass
+            elif 'defns' in response:
+                handler.set_definitions_info(self, response['defns'], trg)
+        finally:
+            handler.done()
+
+    def async_eval_at_trg(self, handler, trg, silent=False, keep_existing=False, snapshot=None):
         self.service.send(
             command='eval',
+            vid=self.vid,
             trg=trg,
             silent=silent,
             keep_existing=keep_existing,
-            callback=callback,
+            priority=PRIORITY_IMMEDIATE,
+            callback=functools.partial(self._post_eval_handler, handler, trg, snapshot=snapshot),
         )
 
     def to_html_async(self, callback, flags=None, title=None):
@@ -1268,6 +3134,7 @@ class CodeIntelBuffer(object):
         self.service.send(
             command='buf-to-html',
             path=self.path,
+            vid=self.vid,
             language=self.lang,
             text=self.text,
             env={
@@ -1276,6 +3143,7 @@ class CodeIntelBuffer(object):
             },
             title=title,
             flags=flag_dict,
+            priority=PRIORITY_CURRENT,
             callback=invoke_callback,
         )
 
@@ -1302,6 +3170,7 @@ class CodeIntelBuffer(object):
         self.service.send(
             command='calltip-arg-range',
             path=self.path,
+            vid=self.vid,
             language=self.lang,
             text=self.text,
             encoding='utf-8',
@@ -1312,5 +3181,6 @@ class CodeIntelBuffer(object):
                 'env': self.env,
                 'prefs': self.prefs,
             },
+            priority=PRIORITY_IMMEDIATE,
             callback=callback,
         )
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio engine for the CodeIntelManager.
+
+Instead of a thread reading, another one sending and a watchdog thread (all
+coordinated through a Condition and a Queue), everything runs as tasks of an
+asyncio event loop in the manager thread: non-blocking stream reads and
+writes, awaiting the child process exit and timers for the request timeouts.
+
+Requires Python 3.5 or above (async/await syntax); it's only imported when
+the asyncio engine is selected (see codeintel.get_manager_class()).
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import sys
+import socket
+import asyncio
+import threading
+import subprocess
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .codeintel import CodeIntelManager, _FrameReader
+
+if sys.platform.startswith("win"):
+    raise ImportError("named pipes are not supported by the asyncio engine on Windows")
+
+__all__ = ["AsyncioCodeIntelManager"]
+
+
+class _AsyncPipe(object):
+    """File-like (writev/close) facade over the asyncio streams to the child;
+    it can be used from any thread, the work is handed to the event loop."""
+
+    def __init__(self, mgr, reader, writer, transports):
+        self._mgr = mgr
+        self.reader = reader
+        self.writer = writer
+        self._transports = transports  # (besides the writer's)
+
+    def writev(self, bufs):
+        self._mgr._call_in_loop(self.writer.writelines, bufs)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self._mgr._call_in_loop(self._close)
+
+    def _close(self):
+        self.writer.close()
+        for transport in self._transports:
+            transport.close()
+
+
+class AsyncioCodeIntelManager(CodeIntelManager):
+    """CodeIntelManager running on a single asyncio event loop"""
+
+    _loop = None
+    _wakeup = None  # asyncio.Event, set when the sender has something to do
+
+    def __init__(self, *args, **kwargs):
+        CodeIntelManager.__init__(self, *args, **kwargs)
+        self._timeouts = {}  # keyed by request id; value is the timer handle (only touched in the loop)
+        self._watchers = set()  # tasks waiting for children to exit (see _watch)
+
+    @CodeIntelManager.state.setter
+    def state(self, state):
+        CodeIntelManager.state.fset(self, state)
+        self._call_in_loop(self._wake_sender)  # might be able (or have) to send now
+
+    def _call_in_loop(self, fn, *args):
+        """Call fn in the event loop thread (right now if already there)"""
+        loop = self._loop
+        if loop is None:
+            return
+        if threading.current_thread() is self:
+            fn(*args)
+            return
+        try:
+            loop.call_soon_threadsafe(fn, *args)
+        except RuntimeError:
+            pass  # loop is closed, the manager is gone
+
+    def _wake_sender(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _queue_request(self, callback, kwargs):
+        CodeIntelManager._queue_request(self, callback, kwargs)
+        self._call_in_loop(self._wake_sender)
+
+    def _start_sending(self):
+        """The sender task is always running, it waits for the ready state"""
+
+    def _start_standby(self):
+        """No hot standby, children are spawned by the event loop"""
+
+    def _forget_request(self, req_id):
+        CodeIntelManager._forget_request(self, req_id)
+        self._call_in_loop(self._cancel_timeout, req_id)
+        self._call_in_loop(self._wake_sender)  # may have room in flight now
+
+    def _schedule_timeout(self, req_id, delay):
+        """Timeouts are timers of the event loop (cancelled on completion)"""
+        self._call_in_loop(self._schedule_loop_timeout, req_id, delay)
+
+    def _schedule_loop_timeout(self, req_id, delay):
+        self._cancel_timeout(req_id)
+        self._timeouts[req_id] = self._loop.call_later(delay, self._loop_timed_out, req_id)
+
+    def _cancel_timeout(self, req_id):
+        handle = self._timeouts.pop(req_id, None)
+        if handle:
+            handle.cancel()
+
+    def _loop_timed_out(self, req_id):
+        self._timeouts.pop(req_id, None)
+        self._timed_out(req_id)
+
+    def _call_later(self, delay, fn):
+        """Timers are those of the event loop"""
+        self._call_in_loop(self._loop_call_later, delay, fn)
+
+    def _loop_call_later(self, delay, fn):
+        self._loop.call_later(delay, fn)
+
+    def run(self):
+        """Event loop for the codeintel manager background thread"""
+        assert threading.current_thread().name != "MainThread", \
+            "CodeIntelManager.run should run on background thread!"
+
+        self.log.info("%s thread started..." % threading.current_thread().name)
+
+        self._warm_start()
+
+        loop = asyncio.new_event_loop()
+        self._loop = loop
+        try:
+            loop.run_until_complete(self._main())
+        finally:
+            self._loop = None
+            loop.close()
+
+        self.log.info("%s thread ended!" % threading.current_thread().name)
+
+    async def _main(self):
+        self._wakeup = asyncio.Event()
+        sender = self._loop.create_task(self._send_queued())
+        try:
+            while self.state not in (CodeIntelManager.STATE_QUITTING, CodeIntelManager.STATE_DESTROYED):
+                ok = False
+
+                await self._init_child()
+                if not self.proc:
+                    break  # init child failed
+
+                first_buf = True
+                pipe = self.pipe
+                try:
+                    frames = _FrameReader()
+                    while self.proc and self.pipe is pipe:
+                        # Loop to read frames from the pipe
+                        data = await pipe.reader.read(frames.buffer_size)
+                        if not data:
+                            # nothing read, EOF
+                            raise IOError("Failed to read from socket")
+                        frames.feed(data)
+                        for frame in frames.pending_frames():
+                            ok = True
+                            self._receive(frame, first_buf)
+                            first_buf = False
+
+                except Exception as e:
+                    if self.state in (CodeIntelManager.STATE_QUITTING, CodeIntelManager.STATE_DESTROYED):
+                        self.log.debug("IOError in codeintel during shutdown; ignoring")
+                        break  # this is intentional
+                    message = "Error reading data from OOP CodeIntel: %s" % e
+                    self.log.error(message)
+                    self._progress_callback(self, message)
+                    self.state = CodeIntelManager.STATE_WAITING
+                    self.close()
+
+                if not ok:
+                    await asyncio.sleep(3)
+        finally:
+            sender.cancel()
+            pipe = self.pipe
+            if pipe:
+                pipe._close()  # the loop is going away, close right now
+            for handle in self._timeouts.values():
+                handle.cancel()
+            self._timeouts.clear()
+            if self._watchers:
+                # let the (killed or quitting) children be reaped while the loop is still around
+                await asyncio.wait(self._watchers, timeout=2)
+            for watcher in self._watchers:
+                watcher.cancel()
+            await asyncio.gather(sender, *self._watchers, return_exceptions=True)
+
+    async def _init_child(self):
+        self.log.debug("initializing child process")
+        conn = None
+        self._reset_protocol_state()
+        self._replay_requests()  # (queued until the new child is ready)
+        try:
+            conn = self._child_connection()
+            cmd = self._child_command(conn)
+
+            if self._oop_mode == 'server':
+                if self._cmd_messge:
+                    self._cmd_messge = False
+                    self.log.warn("Please start OOP server with command: %s", " ".join(cmd))
+                self.proc = True
+            else:
+                self.log.debug("Running OOP: %s", " ".join(cmd))
+                self.proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True)
+                conn.child = self.proc
+                assert self.proc.returncode is None, "Early process death!"
+                watcher = self._loop.create_task(self._watch(self.proc))
+                self._watchers.add(watcher)
+                watcher.add_done_callback(self._watchers.discard)
+
+            try:
+                self.pipe = await self._open_pipe(conn)
+                self._cmd_messge = True
+                self.log.info("Successfully connected with OOP CodeIntel!")
+            except Exception:
+                self.pipe = None
+                self._check_oop_mode()
+
+            conn.cleanup()  # This will remove the filesystem files (it keeps the fds open)
+
+            self.state = CodeIntelManager.STATE_CONNECTED
+        except Exception as e:
+            if conn:
+                try:
+                    conn.cleanup()  # don't leave pipes or sockets behind
+                except Exception:
+                    pass
+            self.kill()
+            message = "Error initing child: %s" % e
+            self.log.error(message)
+            self._progress_callback(self, message)
+        else:
+            self._schedule_init_requests()
+
+    async def _open_pipe(self, conn):
+        """Connect to the child and wrap the connection in asyncio streams"""
+        await self._loop.run_in_executor(None, conn.get_stream)
+        sock = conn.get_socket()
+        if sock is None:
+            read, write = conn.get_files()
+            reader = asyncio.StreamReader()
+            read_transport, _ = await self._loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), read)
+            write_transport, protocol = await self._loop.connect_write_pipe(
+                asyncio.streams.FlowControlMixin, write)
+            writer = asyncio.StreamWriter(write_transport, protocol, reader, self._loop)
+            return _AsyncPipe(self, reader, writer, (read_transport,))
+        if getattr(socket, 'AF_UNIX', None) is not None and sock.family == socket.AF_UNIX:
+            reader, writer = await asyncio.open_unix_connection(sock=sock)
+        else:
+            reader, writer = await asyncio.open_connection(sock=sock)
+        return _AsyncPipe(self, reader, writer, ())
+
+    async def _watch(self, proc):
+        self.log.debug("Watchdog witing for OOP codeintel process to die...")
+        await proc.wait()
+        self.log.info("Child OOP CodeIntel process died!")
+        if self.proc is proc and self.state not in (CodeIntelManager.STATE_QUITTING, CodeIntelManager.STATE_DESTROYED):
+            self.state = CodeIntelManager.STATE_WAITING
+            self.close()
+
+    async def _send_queued(self):
+        """Task to send unsent requests, whatever is queued is coalesced
+        (within the batch limits) into a single write"""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self.state is CodeIntelManager.STATE_DESTROYED:
+                break
+            if self.state not in (CodeIntelManager.STATE_READY, CodeIntelManager.STATE_QUITTING):
+                continue  # wait...
+            if self._batch_max_latency:
+                await asyncio.sleep(self._batch_max_latency)
+            stop = False
+            frames = []
+            size = 0
+            while size < self._batch_max_bytes and len(frames) < self._batch_max_frames:
+                try:
+                    callback, kwargs = self.unsent_requests.get(False)
+                except queue.Empty:
+                    break
+                if callback is None and kwargs is None:
+                    # end of queue (shutting down)
+                    stop = True
+                    break
+                frame = self._prepare_frame(callback, kwargs)
+                if frame:
+                    frames.append(frame)
+                    size += len(frame[0]) + len(frame[1])
+            else:
+                self._wakeup.set()  # batch is full, there may be more queued
+            if frames:
+                self._write_frames(frames)
+                pipe = self.pipe
+                if pipe:
+                    try:
+                        await pipe.drain()
+                    except Exception as e:
+                        pass  # the reader finds out the connection is broken
+            if stop:
+                break
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal pure Python MessagePack encoder/decoder.
+
+Only the subset of MessagePack needed by the OOP protocol is supported:
+nil, booleans, integers, floats, strings, binary, arrays and maps (no ext
+types). Strings are sent as raw UTF-8 so big texts need no escaping, and
+decoding works directly over memoryviews.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import codecs
+import struct
+
+__all__ = ["dumps", "loads", "MAP_MARKERS"]
+
+try:
+    text_type = unicode
+    binary_type = str
+    integer_types = (int, long)
+except NameError:
+    text_type = str
+    binary_type = bytes
+    integer_types = (int,)
+
+# first bytes a packed map can start with (fixmap, map 16 and map 32)
+MAP_MARKERS = frozenset(list(range(0x80, 0x90)) + [0xde, 0xdf])
+
+_utf8_decode = codecs.getdecoder('utf-8')
+
+_pack_B = struct.Struct(">B").pack
+_pack_BB = struct.Struct(">BB").pack
+_pack_BH = struct.Struct(">BH").pack
+_pack_BI = struct.Struct(">BI").pack
+_pack_Bb = struct.Struct(">Bb").pack
+_pack_Bh = struct.Struct(">Bh").pack
+_pack_Bi = struct.Struct(">Bi").pack
+_pack_BQ = struct.Struct(">BQ").pack
+_pack_Bq = struct.Struct(">Bq").pack
+_pack_Bd = struct.Struct(">Bd").pack
+
+
+def _pack_length(parts, length, fix, fix_max, marker8, marker16, marker32):
+    if length <= fix_max:
+        parts.append(_pack_B(fix | length))
+    elif marker8 is not None and length <= 0xff:
+        parts.append(_pack_BB(marker8, length))
+    elif length <= 0xffff:
+        parts.append(_pack_BH(marker16, length))
+    else:
+        parts.append(_pack_BI(marker32, length))
+
+
+def _pack(obj, parts):
+    if obj is None:
+        parts.append(b'\xc0')
+    elif obj is True:
+        parts.append(b'\xc3')
+    elif obj is False:
+        parts.append(b'\xc2')
+    elif isinstance(obj, text_type):
+        data = obj.encode('utf-8')
+        _pack_length(parts, len(data), 0xa0, 31, 0xd9, 0xda, 0xdb)
+        parts.append(data)
+    elif isinstance(obj, integer_types):
+        if 0 <= obj <= 0x7f:
+            parts.append(_pack_B(obj))
+        elif -32 <= obj < 0:
+            parts.append(_pack_B(obj & 0xff))
+        elif 0 <= obj <= 0xff:
+            parts.append(_pack_BB(0xcc, obj))
+        elif 0 <= obj <= 0xffff:
+            parts.append(_pack_BH(0xcd, obj))
+        elif 0 <= obj <= 0xffffffff:
+            parts.append(_pack_BI(0xce, obj))
+        elif 0 <= obj <= 0xffffffffffffffff:
+            parts.append(_pack_BQ(0xcf, obj))
+        elif -0x80 <= obj:
+            parts.append(_pack_Bb(0xd0, obj))
+        elif -0x8000 <= obj:
+            parts.append(_pack_Bh(0xd1, obj))
+        elif -0x80000000 <= obj:
+            parts.append(_pack_Bi(0xd2, obj))
+        elif -0x8000000000000000 <= obj:
+            parts.append(_pack_Bq(0xd3, obj))
+        else:
+            raise ValueError("Integer out of range: %r" % obj)
+    elif isinstance(obj, float):
+        parts.append(_pack_Bd(0xcb, obj))
+    elif isinstance(obj, dict):
+        _pack_length(parts, len(obj), 0x80, 15, None, 0xde, 0xdf)
+        for key, value in obj.items():
+            _pack(key, parts)
+            _pack(value, parts)
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(parts, len(obj), 0x90, 15, None, 0xdc, 0xdd)
+        for value in obj:
+            _pack(value, parts)
+    elif isinstance(obj, (binary_type, bytearray, memoryview)):
+        data = bytes(obj)
+        _pack_length(parts, len(data), 0, -1, 0xc4, 0xc5, 0xc6)
+        parts.append(data)
+    else:
+        raise TypeError("Can't serialize %r" % (obj,))
+
+
+def dumps(obj):
+    """Serialize obj to MessagePack bytes"""
+    parts = []
+    _pack(obj, parts)
+    return b''.join(parts)
+
+
+_unpack_H = struct.Struct(">H").unpack_from
+_unpack_I = struct.Struct(">I").unpack_from
+_unpack_Q = struct.Struct(">Q").unpack_from
+_unpack_b = struct.Struct(">b").unpack_from
+_unpack_h = struct.Struct(">h").unpack_from
+_unpack_i = struct.Struct(">i").unpack_from
+_unpack_q = struct.Struct(">q").unpack_from
+_unpack_f = struct.Struct(">f").unpack_from
+_unpack_d = struct.Struct(">d").unpack_from
+
+# (unpacker, size) of the fixed size numbers, by marker
+_numbers = {
+    0xca: (_unpack_f, 4),
+    0xcb: (_unpack_d, 8),
+    0xcd: (_unpack_H, 2),
+    0xce: (_unpack_I, 4),
+    0xcf: (_unpack_Q, 8),
+    0xd0: (_unpack_b, 1),
+    0xd1: (_unpack_h, 2),
+    0xd2: (_unpack_i, 4),
+    0xd3: (_unpack_q, 8),
+}
+
+# (unpacker, size) of the lengths of strings, binaries, arrays and maps, by marker
+_lengths = {
+    0xc4: (None, 1), 0xc5: (_unpack_H, 2), 0xc6: (_unpack_I, 4),  # bin
+    0xd9: (None, 1), 0xda: (_unpack_H, 2), 0xdb: (_unpack_I, 4),  # str
+    0xdc: (_unpack_H, 2), 0xdd: (_unpack_I, 4),  # array
+    0xde: (_unpack_H, 2), 0xdf: (_unpack_I, 4),  # map
+}
+
+
+def _unpack(data, pos):
+    """Return tuple (object, position after it) of the object at pos"""
+    marker = data[pos]
+    pos += 1
+    if marker <= 0x7f:
+        return marker, pos
+    if marker >= 0xe0:
+        return marker - 0x100, pos
+    if 0xa0 <= marker <= 0xbf:
+        length = marker & 0x1f
+        return _utf8_decode(data[pos:pos + length])[0], pos + length
+    if 0x90 <= marker <= 0x9f:
+        kind, length = 0x90, marker & 0x0f
+    elif 0x80 <= marker <= 0x8f:
+        kind, length = 0x80, marker & 0x0f
+    elif marker == 0xc0:
+        return None, pos
+    elif marker == 0xc2:
+        return False, pos
+    elif marker == 0xc3:
+        return True, pos
+    elif marker == 0xcc:
+        return data[pos], pos + 1
+    elif marker in _numbers:
+        unpack, size = _numbers[marker]
+        return unpack(data, pos)[0], pos + size
+    elif marker in _lengths:
+        unpack, size = _lengths[marker]
+        length = data[pos] if unpack is None else unpack(data, pos)[0]
+        pos += size
+        if marker <= 0xc6:
+            return bytes(data[pos:pos + length]), pos + length
+        if marker <= 0xdb:
+            return _utf8_decode(data[pos:pos + length])[0], pos + length
+        kind = 0x90 if marker <= 0xdd else 0x80
+    else:
+        raise ValueError("Unsupported MessagePack marker: 0x%02x" % marker)
+    if kind == 0x90:
+        array = []
+        for i in range(length):
+            value, pos = _unpack(data, pos)
+            array.append(value)
+        return array, pos
+    mapping = {}
+    for i in range(length):
+        key, pos = _unpack(data, pos)
+        value, pos = _unpack(data, pos)
+        mapping[key] = value
+    return mapping, pos
+
+
+def loads(data):
+    """Deserialize MessagePack bytes (or a bytearray or memoryview)"""
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
+    obj, pos = _unpack(data, 0)
+    if pos != len(data):
+        raise ValueError("Extra data after MessagePack object")
+    return obj
@@ -195,6 +195,11 @@ class Win32Pipe(object):
         finally:
             CloseHandle(overlapped.hEvent)
 
+    def writev(self, bufs):
+        """Write all the buffers, joined in a single write (there's no
+        vectored write for named pipes)."""
+        self.write(b''.join(bufs))
+
     def read(self, count):
         self._ensure_stream("read from")
         overlapped = OVERLAPPED()
@@ -216,6 +221,28 @@ class Win32Pipe(object):
         finally:
             CloseHandle(overlapped.hEvent)
 
+    def readinto(self, b):
+        """Read whatever is available (up to len(b) bytes) directly into the
+        writable buffer b; returns the number of bytes read."""
+        self._ensure_stream("read from")
+        overlapped = OVERLAPPED()
+        try:
+            buf = (ctypes.c_char * len(b)).from_buffer(b)
+            if not ReadFile(self._pipe, ctypes.byref(buf), len(b),
+                            None, ctypes.byref(overlapped)):
+                errno = ctypes.get_last_error()
+                if errno != ERROR_IO_PENDING:
+                    raise ctypes.WinError(errno)
+            read = DWORD(0)
+            if not GetOverlappedResult(self._pipe,
+                                       ctypes.byref(overlapped),
+                                       ctypes.byref(read),
+                                       True):
+                raise ctypes.WinError(ctypes.get_last_error())
+            return read.value
+        finally:
+            CloseHandle(overlapped.hEvent)
+
     def close(self):
         CloseHandle(self._pipe)
         self._pipe = None